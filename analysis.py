@@ -0,0 +1,170 @@
+from collections import deque
+from functools import lru_cache
+from math import ceil, floor
+
+import numpy as np
+import scipy.signal as signal
+from scipy.integrate import trapezoid
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _sliding_extreme(x, n, axis, ufunc, method):
+    # ufunc.reduce over every window x[i:i + n] along axis, i = 0 .. len - n
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    length = x.shape[-1]
+    if not 1 <= n <= length:
+        raise ValueError('Window of %d samples does not fit %d samples' % (n, length))
+    if method == 'window':
+        out = ufunc.reduce(sliding_window_view(x, n, axis=-1), axis=-1)
+    elif method == 'blocks':
+        # van Herk / Gil-Werman: running extremes from the left and from the right inside blocks
+        # of n samples; every window spans at most two blocks, so it is the combination of one
+        # suffix and one prefix value, O(len) in total independent of n
+        pad = -length % n
+        fill = -np.inf if ufunc is np.maximum else np.inf
+        xp = np.concatenate((x, np.full(x.shape[:-1] + (pad,), fill, dtype=np.result_type(x, float))), axis=-1)
+        blocks = xp.reshape(x.shape[:-1] + (-1, n))
+        prefix = ufunc.accumulate(blocks, axis=-1).reshape(xp.shape)
+        suffix = np.flip(ufunc.accumulate(np.flip(blocks, -1), axis=-1), -1).reshape(xp.shape)
+        out = ufunc(suffix[..., :length - n + 1], prefix[..., n - 1:length])
+    else:
+        raise ValueError('Unknown method: %s' % method)
+    return np.moveaxis(out, -1, axis)
+
+
+def sliding_max(x, n, axis=-1, method='blocks'):
+    return _sliding_extreme(x, n, axis, np.maximum, method)
+
+
+def sliding_min(x, n, axis=-1, method='blocks'):
+    return _sliding_extreme(x, n, axis, np.minimum, method)
+
+
+def sliding_ptp(x, n, axis=-1, method='blocks'):
+    # np.ptp(x[i:i + n]) for every i, in O(len(x)); method='window' is the direct vectorized
+    # O(len(x) * n) version
+    return sliding_max(x, n, axis, method) - sliding_min(x, n, axis, method)
+
+
+class SlidingPeakToPeak:
+    # Peak-to-peak of the last n samples of a stream, O(1) amortized per sample (monotonic deques).
+    def __init__(self, n):
+        self.n = n
+        self.k = 0
+        self.maxq = deque()
+        self.minq = deque()
+
+    def __call__(self, y):
+        k = self.k
+        self.k += 1
+        while self.maxq and self.maxq[-1][1] <= y:
+            self.maxq.pop()
+        self.maxq.append((k, y))
+        while self.minq and self.minq[-1][1] >= y:
+            self.minq.pop()
+        self.minq.append((k, y))
+        if self.maxq[0][0] <= k - self.n:
+            self.maxq.popleft()
+        if self.minq[0][0] <= k - self.n:
+            self.minq.popleft()
+        return self.value
+
+    @property
+    def value(self):
+        if not self.maxq:
+            return 0
+        return self.maxq[0][1] - self.minq[0][1]
+
+
+# Spectral metrics on stacked trajectories, time along `axis` (the last one by default, e.g. (N, T)
+# for N runs); times in ms, sampling rates in Hz. Filter designs are cached, so calling these per
+# grid point or per controller step does not redesign them.
+
+@lru_cache(maxsize=64)
+def _decimation_sos(q):
+    # the anti-aliasing filter of signal.decimate (ftype='iir')
+    return signal.cheby1(8, 0.05, 0.8 / q, output='sos')
+
+
+@lru_cache(maxsize=64)
+def butter_band(low, high, fs, order=5):
+    # (b, a) of a Butterworth band-pass, as simulation.butter_bandpass
+    nyq = 0.5 * fs
+    return signal.butter(order, [low / nyq, high / nyq], btype='band')
+
+
+def decimate(x, q, axis=-1):
+    # signal.decimate(x, q, axis=axis) with the cached filter
+    x = np.asarray(x, dtype=float)
+    y = signal.sosfiltfilt(_decimation_sos(q), x, axis=axis)
+    sl = [slice(None)] * y.ndim
+    sl[axis] = slice(None, None, q)
+    return y[tuple(sl)]
+
+
+def bandpass(x, band, fs, order=5, axis=-1):
+    # zero-phase Butterworth band-pass (filtfilt), as simulation.butter_bandpass_filter
+    b, a = butter_band(band[0], band[1], fs, order)
+    return signal.filtfilt(b, a, x, axis=axis)
+
+
+def band_amplitude(x, dt, band=(16, 24), div=10, tail_len=None, axis=-1):
+    # peak-to-peak over the last tail_len ms (all of it for None) after decimating by div and
+    # band-passing, or of the raw signal with band=None
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    if band is None:
+        tail = x.shape[-1] if tail_len is None else int(ceil(tail_len / dt))
+        return np.ptp(x[..., -tail:], axis=-1)
+    y = bandpass(decimate(x, div), band, 1000 / (dt * div))
+    tail = y.shape[-1] if tail_len is None else int(floor(int(ceil(tail_len / dt)) / div))
+    return np.ptp(y[..., -tail:], axis=-1)
+
+
+def welch(x, dt, segment=1000, axis=-1):
+    # (frequencies [Hz], power spectral density) with segments of `segment` ms
+    fs = 1000 / dt
+    n = np.shape(x)[axis]
+    return signal.welch(x, fs, nperseg=min(n, int(round(segment / dt))), axis=axis)
+
+
+def band_power(x, dt, band=(13, 30), segment=1000, axis=-1):
+    # power in band, integrated over the Welch spectrum
+    f, p = welch(x, dt, segment, axis)
+    p = np.moveaxis(p, axis, -1)
+    inside = (f >= band[0]) & (f <= band[1])
+    return trapezoid(p[..., inside], f[inside], axis=-1)
+
+
+def envelope(x, dt, band=None, div=1, axis=-1):
+    # Hilbert envelope, of the band-passed signal if band is given, after decimating by div
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    if div > 1:
+        x = decimate(x, div)
+    if band is not None:
+        x = bandpass(x, band, 1000 / (dt * div))
+    else:
+        x = x - x.mean(axis=-1, keepdims=True)
+    return np.moveaxis(np.abs(signal.hilbert(x, axis=-1)), -1, axis)
+
+
+def dominant_frequency(x, dt, fmin=1, fmax=100, segment=1000, axis=-1):
+    # frequency [Hz] of the largest Welch peak between fmin and fmax
+    f, p = welch(x, dt, segment, axis)
+    p = np.moveaxis(p, axis, -1)
+    inside = (f >= fmin) & (f <= fmax)
+    return f[inside][np.argmax(p[..., inside], axis=-1)]
+
+
+def spectral_metrics(x, dt, band=(13, 30), div=10, tail_len=None, segment=1000, axis=-1):
+    # the metrics above for all runs at once, over the last tail_len ms: band amplitude
+    # (peak-to-peak of the band-passed signal), Welch band power, mean Hilbert envelope in the band
+    # and dominant frequency. The filters run over the whole signal, so their edges stay out of the tail.
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    tail = x.shape[-1] if tail_len is None else int(ceil(tail_len / dt))
+    env = envelope(x, dt, band, div)
+    return {
+        'amplitude': band_amplitude(x, dt, band, div, tail_len),
+        'power': band_power(x[..., -tail:], dt, band, segment),
+        'envelope': env[..., -max(1, tail // div):].mean(axis=-1),
+        'frequency': dominant_frequency(x[..., -tail:], dt, segment=segment),
+    }
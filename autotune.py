@@ -0,0 +1,143 @@
+import multiprocessing
+from math import ceil, floor, log
+
+import numpy as np
+
+import simulation as sim
+from analysis import band_amplitude, sliding_ptp
+
+# Automatic tuning of controller parameters by successive halving: many candidates are scored on a
+# short run, the best 1 / eta go on to a longer one, and so on up to the full run, so poor
+# candidates cost only a short simulation. Candidates are scored in batches through a controller
+# bank (batch_simulation) or one per process through a scalar controller (simulate).
+
+
+def sample(space, n, rng=None):
+    # n candidates drawn uniformly from space, {name: (low, high)} or (low, high, 'log') for a
+    # log-uniform draw; {name: (n,) array}
+    rng = np.random.default_rng(rng)
+    params = {}
+    for name, bounds in space.items():
+        low, high = bounds[:2]
+        if len(bounds) > 2 and bounds[2] == 'log':
+            params[name] = np.exp(rng.uniform(log(low), log(high), n))
+        else:
+            params[name] = rng.uniform(low, high, n)
+    return params
+
+
+def settling_time(x, dt, t, after, window=50, tol=1):
+    # per row of x (N, T), ms from `after` until the peak-to-peak over a sliding window [ms] stays
+    # within tol of its final value; t are the times of the columns
+    n = max(1, int(round(window / dt)))
+    r = sliding_ptp(x, n, axis=-1)
+    end = t[n - 1:]
+    unsettled = (np.abs(r - r[:, -1:]) > tol) & (end >= after)
+    last = r.shape[1] - np.argmax(unsettled[:, ::-1], axis=1)
+    settled = np.where(unsettled.any(axis=1), end[np.minimum(last, r.shape[1] - 1)], after)
+    return settled - after
+
+
+def _simulate_one(args):
+    # cost parts of one scalar controller (runs in the pool)
+    constants, simulation_time, dt, controller, kwargs = args
+    history, info = sim.simulate(constants, simulation_time, dt, controller, full_output=True, record_traces=True,
+                                 **kwargs)
+    return history, np.sum(info['control'] ** 2) * dt
+
+
+class TuningObjective:
+    # Cost of controller parameters on one model:
+    #   weights[0] * beta amplitude of the STN over the last tail_len ms, relative to the uncontrolled run
+    #   + weights[1] * settling time after mid_increase, as a fraction of the rest of the run
+    #   + weights[2] * mean power of the control input after control_start
+    # bank is called as bank(**{name: (N,) array}) and scores candidates batch_size at a time;
+    # controller as controller(**{name: value}) and scores them on a pool of `processes`.
+    def __init__(self, constants, dt, bank=None, controller=None, control_start=200, init_state=[20, 20, 0],
+                 mid_increase=(750, 15, 0), band=(13, 30), tail_len=500, settle_window=50, settle_tol=1,
+                 weights=(1, 1, 1e-3), batch_size=32, processes=None):
+        if (bank is None) == (controller is None):
+            raise ValueError('Give either a controller bank or a controller factory')
+        self.constants = list(constants)
+        self.dt = dt
+        self.bank = bank
+        self.controller = controller
+        self.kwargs = {'control_start': control_start, 'init_state': init_state, 'mid_increase': mid_increase}
+        self.band = band
+        self.tail_len = tail_len
+        self.settle_window = settle_window
+        self.settle_tol = settle_tol
+        self.weights = weights
+        self.batch_size = batch_size
+        self.processes = processes
+        self.references = {}
+        self.evaluations = 0
+
+    def _beta(self, history):
+        return band_amplitude(history[..., 0], self.dt, self.band, tail_len=self.tail_len)
+
+    def reference(self, simulation_time):
+        # beta amplitude of the uncontrolled run
+        if simulation_time not in self.references:
+            history = sim.batch_simulation([self.constants], simulation_time, self.dt, None, **self.kwargs)
+            self.references[simulation_time] = self._beta(history)[0]
+        return self.references[simulation_time]
+
+    def _runs(self, params, simulation_time):
+        # (history rows, control energy) per candidate
+        n = len(next(iter(params.values())))
+        if self.bank is not None:
+            for k in range(0, n, self.batch_size):
+                chunk = {name: values[k:k + self.batch_size] for name, values in params.items()}
+                m = len(next(iter(chunk.values())))
+                history, info = sim.batch_simulation([self.constants] * m, simulation_time, self.dt,
+                                                     self.bank(**chunk), full_output=True, **self.kwargs)
+                yield history, info['control_energy']
+            return
+        tasks = [(self.constants, simulation_time, self.dt,
+                  self.controller(**{name: values[k] for name, values in params.items()}), self.kwargs)
+                 for k in range(n)]
+        with multiprocessing.Pool(self.processes) as pool:
+            for history, energy in pool.imap(_simulate_one, tasks):
+                yield history[np.newaxis], np.array([energy])
+
+    def __call__(self, params, simulation_time):
+        # (costs (N,), {'beta', 'settling', 'power'} (N,) each) of the candidates in params
+        mid = self.kwargs['mid_increase'][0]
+        start, delta, n_steps = sim._time_grid(max(self.constants[6:10]), simulation_time, self.dt)
+        t = start + np.arange(n_steps) * delta
+        beta, settling, power = [], [], []
+        for history, energy in self._runs(params, simulation_time):
+            beta.append(self._beta(history))
+            if simulation_time > mid:
+                settling.append(settling_time(history[..., 0], self.dt, t, mid, self.settle_window,
+                                              self.settle_tol) / (simulation_time - mid))
+            else:
+                settling.append(np.zeros(len(history)))
+            power.append(energy / max(simulation_time - self.kwargs['control_start'], self.dt))
+        parts = {'beta': np.concatenate(beta) / self.reference(simulation_time),
+                 'settling': np.concatenate(settling), 'power': np.concatenate(power)}
+        self.evaluations += len(parts['beta'])
+        costs = self.weights[0] * parts['beta'] + self.weights[1] * parts['settling'] + \
+            self.weights[2] * parts['power']
+        return np.where(np.isfinite(costs), costs, np.inf), parts
+
+
+def successive_halving(objective, space, n=81, eta=3, min_time=1000, max_time=3000, rng=None):
+    # Scores n candidates from space (see sample) with objective(params, simulation_time) ->
+    # (costs, parts) on rungs of growing simulation time, from min_time to max_time geometrically,
+    # keeping the best 1 / eta of each rung. Returns (best parameters, their cost, the rungs as
+    # dicts of simulation_time, params, costs and parts).
+    params = sample(space, n, rng)
+    levels = max(1, int(floor(log(n) / log(eta) + 1e-9)))
+    rungs = []
+    for r in range(levels + 1):
+        simulation_time = min_time * (max_time / min_time) ** (r / levels)
+        costs, parts = objective(params, simulation_time)
+        rungs.append({'simulation_time': simulation_time, 'params': params, 'costs': costs, 'parts': parts})
+        keep = np.argsort(costs, kind='stable')[:max(1, int(ceil(len(costs) / eta)))]
+        if r == levels or len(costs) == 1:
+            break
+        params = {name: values[keep] for name, values in params.items()}
+    best = int(np.argmin(costs))
+    return {name: values[best] for name, values in params.items()}, costs[best], rungs
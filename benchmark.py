@@ -0,0 +1,189 @@
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+
+import controller as ctrl
+import simulation as sim
+from sweep import AmplitudePoint, grid_points
+
+# Timings of the simulation engine and the controllers, written to simulation_results/benchmarks as
+# JSON (one file per run, named after the time and commit) so runs on different commits can be
+# compared: set baseline to an earlier file to print the ratios.
+
+# (name, factory taking dt, longest run [ms]); AdaptiveControllerFilter refilters its whole tail every
+# step once it has tail_len = 500 ms of history and is only run 100 ms past that
+CONTROLLERS = [
+    ('ZeroController', lambda dt: ctrl.ZeroController(), None),
+    ('ProportionalController', lambda dt: ctrl.ProportionalController(gain=2, dt=dt), None),
+    ('AdaptiveController', lambda dt: ctrl.AdaptiveController(sigma=0.19, tau_theta=75, dt=dt), None),
+    ('AdaptiveControllerFilter', lambda dt: ctrl.AdaptiveControllerFilter(0.1, 50, dt), 600),
+    ('StreamingAdaptiveControllerFilter', lambda dt: ctrl.StreamingAdaptiveControllerFilter(0.1, 50, dt), None),
+    ('MemoryLessController', lambda dt: ctrl.MemoryLessController(gain=1, betas=[0.1], dt=dt), None),
+]
+FUNCTIONS = [('single_simulation', sim.single_simulation),
+             ('single_simulation_striatal', sim.single_simulation_striatal)]
+BACKENDS = ['python', 'compiled']
+DTS = [0.1, 0.05]
+SIMULATION_TIMES = [500, 2000]
+
+
+def measure(function, repeat=3):
+    # (best wall time [s] of up to repeat calls, peak traced memory [bytes] of one more call); calls
+    # over a second are not repeated. tracemalloc slows Python code down, so memory is measured separately
+    seconds = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - t0)
+        if seconds > 1:
+            break
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def engine_cases(constants, repeat=3):
+    cases = []
+    for function_name, function in FUNCTIONS:
+        for controller_name, factory, max_time in CONTROLLERS:
+            for backend in BACKENDS:
+                if backend != 'python' and factory(DTS[0]).kernel_spec() is None:
+                    # no kernel, the run would fall back to Python
+                    continue
+                # compiles (or loads) the kernels outside the timings
+                function(constants, 50, DTS[0], factory(DTS[0]), backend=backend)
+                for dt in DTS:
+                    for simulation_time in sorted({min(t, max_time or t) for t in SIMULATION_TIMES}):
+                        steps = sim._time_grid(max(constants[6:10]), simulation_time, dt)[2]
+                        seconds, peak = measure(lambda: function(constants, simulation_time, dt, factory(dt),
+                                                                 backend=backend), repeat)
+                        cases.append({'function': function_name, 'controller': controller_name, 'backend': backend,
+                                      'dt': dt, 'simulation_time': simulation_time, 'steps': steps,
+                                      'seconds': seconds, 'steps_per_second': steps / seconds,
+                                      'peak_memory': peak})
+                        print('%-27s %-34s %-8s dt=%-5g T=%-5g %10.0f steps/s %8.1f MB' % (
+                            function_name, controller_name, backend, dt, simulation_time, steps / seconds,
+                            peak / 2 ** 20))
+    return cases
+
+
+def figure_1a_sweep():
+    # 4 x 4 corner of the Figure 1a grid, batched as in simulate_figure_1a.py
+    constants = list(sim.constants_nevado_holgado_healthy)
+    constants[5] = -4
+    constants[14] = 8
+    constants[15] = -139.4
+    point = AmplitudePoint(constants, 1000, 0.5, tail_len=400, band=(16, 24), div=10)
+    grid = {3: np.arange(0, -4, -1), 4: np.arange(0, 32, 8)}
+    return point.batch([params for _, params in grid_points(grid)])
+
+
+def figure_2a_sweep(streaming_filter=False):
+    # four frequencies at both cortical levels, without control (batched) and with self-tuning control:
+    # the filtfilt estimator simulate_figure_2a.py runs by default, or its streaming_filter option
+    constants = list(sim.constants_nevado_holgado_healthy)
+    constants[5] = -0.9
+    constants[16] = 10
+    dt = 0.05
+    grid = {17: np.array([5, 20, 35, 50]), 18: np.array([10, 22])}
+    params = [p for _, p in grid_points(grid)]
+    zero = AmplitudePoint(constants, 1000, dt, band=None, control_start=200, tail_len=400)
+    if streaming_filter:
+        controller = partial(ctrl.StreamingAdaptiveControllerFilter, 0.1, 50, dt)
+    else:
+        controller = partial(ctrl.AdaptiveControllerFilter, 0.1, 50, dt)
+    adaptive = AmplitudePoint(constants, 1000, dt, controller=controller, band=None, control_start=200, tail_len=400,
+                              init_state=[20, 20, 0])
+    return zero.batch(params), [adaptive(p) for p in params]
+
+
+def figure_3_runs():
+    # Figure 3 with a shorter run and settling pad, no steady-state cache
+    constants = list(sim.constants_nevado_holgado_healthy)
+    constants[3] = -3
+    constants[4] = 10
+    constants[5] = -0.9
+    constants[14] = 5
+    constants[15] = -139.4
+    dt = 0.01
+    for controller, init_state in [(ctrl.AdaptiveController(sigma=0.19, tau_theta=75, dt=dt), [20, 20, 0]),
+                                   (ctrl.ProportionalController(gain=2, dt=dt), 2)]:
+        sim.single_simulation(constants, 1000, dt, controller, control_start=200, init_state=init_state,
+                              mid_increase=(750, 15, 0), steady_state_pad=200, backend='compiled')
+
+
+def sweep_cases(repeat=1):
+    cases = []
+    for name, function in [('figure_1a', figure_1a_sweep), ('figure_2a', figure_2a_sweep),
+                           ('figure_2a_streaming', partial(figure_2a_sweep, streaming_filter=True)),
+                           ('figure_3', figure_3_runs)]:
+        seconds, peak = measure(function, repeat)
+        cases.append({'sweep': name, 'seconds': seconds, 'peak_memory': peak})
+        print('%-10s %8.2f s %8.1f MB' % (name, seconds, peak / 2 ** 20))
+    return cases
+
+
+def compare(baseline, result):
+    # ratio of the new steps/s (engine) or speed (sweeps) to the baseline, > 1 is faster
+    def keyed(cases, fields):
+        return {tuple(case[f] for f in fields): case for case in cases}
+
+    engine_fields = ['function', 'controller', 'backend', 'dt', 'simulation_time']
+    old = keyed(baseline['engine'], engine_fields)
+    for key, case in keyed(result['engine'], engine_fields).items():
+        if key in old:
+            print('%-70s %6.2fx' % (' '.join(str(k) for k in key),
+                                    case['steps_per_second'] / old[key]['steps_per_second']))
+    old = keyed(baseline['sweeps'], ['sweep'])
+    for key, case in keyed(result['sweeps'], ['sweep']).items():
+        if key in old:
+            print('%-70s %6.2fx' % (key[0], old[key]['seconds'] / case['seconds']))
+
+
+if __name__ == '__main__':
+    # healthy model with the Figure 2a/4 GPe self-inhibition and a 20 Hz cortical drive
+    constants = list(sim.constants_nevado_holgado_healthy)
+    constants[5] = -0.9
+    constants[16] = 10
+    constants[17] = 20
+
+    baseline = None
+    path = 'simulation_results/benchmarks'
+
+    commit = _commit()
+    result = {
+        'commit': commit,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'engine': engine_cases(constants),
+        'sweeps': sweep_cases(),
+    }
+    os.makedirs(path, exist_ok=True)
+    name = os.path.join(path, '%s_%s.json' % (datetime.now().strftime('%Y%m%d-%H%M%S'), commit or 'nogit'))
+    with open(name, 'w') as f:
+        json.dump(result, f, indent=1)
+    print('Saved', name)
+    if baseline is not None:
+        with open(baseline) as f:
+            compare(json.load(f), result)
@@ -1,6 +1,8 @@
 import numpy as np
 import scipy.signal as signal
 
+import kernels
+from analysis import SlidingPeakToPeak, bandpass, decimate
 import simulation as sim
 
 
@@ -8,11 +10,39 @@ def rect(x):
     return np.piecewise(x, [x > 0], [x, 0])
 
 
+class _SosFilter:
+    # causal second-order-sections filter fed one sample at a time (transposed direct form II)
+    def __init__(self, sos):
+        self.sos = [tuple(float(v) for v in section) for section in sos]
+        self.zi_unit = signal.sosfilt_zi(sos)
+        self.zi = None
+
+    def __call__(self, x):
+        if self.zi is None:
+            # start from the steady state of a constant input to avoid a start-up transient
+            self.zi = [[z0 * x, z1 * x] for z0, z1 in self.zi_unit]
+        for (b0, b1, b2, _, a1, a2), z in zip(self.sos, self.zi):
+            y = b0 * x + z[0]
+            z[0] = b1 * x - a1 * y + z[1]
+            z[1] = b2 * x - a2 * y
+            x = y
+        return x
+
+
 class Controller:
+    # Controllers are called with the history so far and return (control input, theta gradient).
+    # Those that only need the current state also implement step(state, t), which lets the
+    # simulation run on a ring buffer instead of the full history.
 
     def grad_theta(self, history):
         return 0
 
+    def kernel_spec(self):
+        # (kind, params) for kernels.euler_kernel, or None if this controller has to run in Python.
+        # The kernel only knows the built-in controllers, so subclasses (which may override step)
+        # get None unless they give their own spec.
+        return None
+
 
 class ZeroController(Controller):
     def __init__(self):
@@ -24,6 +54,14 @@ class ZeroController(Controller):
     def __call__(self, *args, **kwargs):
         return 0, 0
 
+    def step(self, state, t=None):
+        return 0, 0
+
+    def kernel_spec(self):
+        if type(self) is not ZeroController:
+            return None
+        return kernels.CONTROLLER_ZERO, [0, 0, 0, 0, 1, 0]
+
 
 # class ProportionalController(Controller):
 #     def __init__(self, gain, dt, omega=0.01):
@@ -58,12 +96,17 @@ class ProportionalController(Controller):
         return state[0] - self.w
 
     def __call__(self, history):
-        state = history[-1]
+        return self.step(history[-1])
+
+    def step(self, state, t=None):
         self._update_w(state)
         input_signal = -self.gain * self.error_signal(state)
         return input_signal, 0
 
-
+    def kernel_spec(self):
+        if type(self) is not ProportionalController:
+            return None
+        return kernels.CONTROLLER_PROPORTIONAL, [self.gain, self.omega, self.dt, 0, 1, 0]
 
 
 class AdaptiveController(Controller):
@@ -87,17 +130,28 @@ class AdaptiveController(Controller):
         return grad
 
     def __call__(self, history):
-        state = history[-1]
+        return self.step(history[-1])
+
+    def step(self, state, t=None):
         gain = state[2]
         control_input = -gain * self.error_signal(state)
         self._update_w(state)
-        return control_input, self.grad_theta(history)
+        return control_input, (abs(self.error_signal(state)) - self.sigma * state[2]) / self.tau_theta
+
+    def kernel_spec(self):
+        if type(self) is not AdaptiveController:
+            return None
+        return kernels.CONTROLLER_ADAPTIVE, [0, self.omega, self.dt, self.sigma, self.tau_theta, 0]
     
 
 class AdaptiveControllerFilter(AdaptiveController):
+    # reads the last `window` rows of the history, so it has no step()
+    step = None
+
     def __init__(self, sigma, tau_theta, dt, tail_len=500, omega=0.1, deadzone=0):
         super().__init__(sigma, tau_theta, dt, tail_len, omega)
         self.samples = int(self.tail_len / self.dt)
+        self.window = self.samples
         self.deadzone = deadzone
 
     def grad_theta(self, history):
@@ -108,8 +162,7 @@ class AdaptiveControllerFilter(AdaptiveController):
 
     def error_signal(self, state):
         s = state[:, 0]
-        s10 = signal.decimate(s, 10)
-        e = np.ptp(sim.butter_bandpass_filter(s10, 15, 30, 100 / self.dt, 5))
+        e = np.ptp(bandpass(decimate(s, 10), (15, 30), 100 / self.dt))
         if e < self.deadzone:
             return 0
         else:
@@ -130,6 +183,54 @@ class AdaptiveControllerFilter(AdaptiveController):
             return control_input, self.grad_theta(history)
 
 
+class StreamingAdaptiveControllerFilter(AdaptiveControllerFilter):
+    # Causal, O(1)-per-step variant of AdaptiveControllerFilter: the anti-aliasing and band-pass
+    # filters keep their state between calls and the peak-to-peak over the last tail_len ms of the
+    # decimated, band-passed STN rate is tracked incrementally.
+    def __init__(self, sigma, tau_theta, dt, tail_len=500, omega=0.1, deadzone=0, q=10, band=(15, 30), order=5):
+        super().__init__(sigma, tau_theta, dt, tail_len, omega, deadzone)
+        self.q = q
+        # same anti-aliasing filter as signal.decimate, applied causally
+        self.decimator = _SosFilter(signal.cheby1(8, 0.05, 0.8 / q, output='sos'))
+        self.bandpass = _SosFilter(sim.butter_bandpass_sos(band[0], band[1], 1000 / (q * dt), order))
+        self.n = 0
+        self.phase = 0
+        self.envelope = SlidingPeakToPeak(max(1, self.samples // q))
+
+    def _update_envelope(self, x):
+        x = self.decimator(x)
+        self.phase = (self.phase + 1) % self.q
+        if self.phase != 1 % self.q:
+            return
+        self.envelope(self.bandpass(x))
+
+    def error_signal(self, state=None):
+        e = self.envelope.value
+        if e < self.deadzone:
+            return 0
+        else:
+            return e
+
+    def grad_theta(self, history):
+        last_state = history[-1]
+        return (abs(self.error_signal()) - self.sigma * last_state[2]) / self.tau_theta
+
+    def __call__(self, history):
+        return self.step(history[-1])
+
+    def step(self, state, t=None):
+        self._update_envelope(state[0])
+        self.n += 1
+        if self.n < self.samples:
+            self._update_w(state)
+            return 0, 0
+        else:
+            gain = state[2]
+            control_input = -gain * (state[0] - self.w)
+            self._update_w(state)
+            return control_input, (abs(self.error_signal()) - self.sigma * state[2]) / self.tau_theta
+
+
 class MemoryLessController(Controller):
     def __init__(self, gain, betas, dt, omega=0.01):
         self.betas = betas
@@ -145,7 +246,68 @@ class MemoryLessController(Controller):
         return state[0] - self.w
 
     def __call__(self, history):
-        state = history[-1]
+        return self.step(history[-1])
+
+    def step(self, state, t=None):
         self._update_w(state)
         input_signal = -self.gain**2 * self.betas[0] * state[0] - self.gain * self.betas[0] * state[0] 
-        return input_signal, 0
\ No newline at end of file
+        return input_signal, 0
+
+    def kernel_spec(self):
+        if type(self) is not MemoryLessController:
+            return None
+        return kernels.CONTROLLER_MEMORYLESS, [self.gain, self.omega, self.dt, 0, 1, self.betas[0]]
+
+
+# Controller banks: N controllers stepped together on the (N, 3) state matrix of batch_simulation.
+# Parameters are scalars or (N,) arrays, the state w becomes an (N,) array on the first step; row k
+# follows the scalar controller with the parameters of row k.
+
+class ProportionalControllerBank(Controller):
+    def __init__(self, gain, dt, omega=0.01):
+        self.gain = np.asarray(gain, dtype=float)
+        self.w = 0
+        self.omega = np.asarray(omega, dtype=float)
+        self.dt = dt
+
+    def __call__(self, state):
+        return self.step(state)
+
+    def step(self, state, t=None):
+        self.w = self.w + self.omega * (state[:, 0] - self.w) * self.dt
+        return -self.gain * (state[:, 0] - self.w), 0
+
+
+class AdaptiveControllerBank(Controller):
+    def __init__(self, sigma, tau_theta, dt, omega=0.1):
+        self.sigma = np.asarray(sigma, dtype=float)
+        self.tau_theta = np.asarray(tau_theta, dtype=float)
+        self.w = 0
+        self.omega = np.asarray(omega, dtype=float)
+        self.dt = dt
+
+    def __call__(self, state):
+        return self.step(state)
+
+    def step(self, state, t=None):
+        control_input = -state[:, 2] * (state[:, 0] - self.w)
+        self.w = self.w + self.omega * (state[:, 0] - self.w) * self.dt
+        return control_input, (np.abs(state[:, 0] - self.w) - self.sigma * state[:, 2]) / self.tau_theta
+
+
+class MemoryLessControllerBank(Controller):
+    # betas: (k,) shared or (N, k), only betas[..., 0] is used as in MemoryLessController
+    def __init__(self, gain, betas, dt, omega=0.01):
+        self.betas = np.asarray(betas, dtype=float)
+        self.gain = np.asarray(gain, dtype=float)
+        self.w = 0
+        self.omega = np.asarray(omega, dtype=float)
+        self.dt = dt
+
+    def __call__(self, state):
+        return self.step(state)
+
+    def step(self, state, t=None):
+        self.w = self.w + self.omega * (state[:, 0] - self.w) * self.dt
+        beta = self.betas[..., 0]
+        return -self.gain ** 2 * beta * state[:, 0] - self.gain * beta * state[:, 0], 0
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+# Convergence detectors for simulate(stop_when=...) and batch_simulation(stop_when=...). They are
+# called with up to the last `window` ms of the run (rows oldest first, shape (rows, 3) or (rows, N, 3)
+# for a batch) and return whether the run has settled, per batch row; runs are only checked from min_time
+# [ms of run time] on. extrapolate continues a settled (rows, 3) window by `rows` more rows, so a
+# stopped run still returns its full length and tail metrics see the settled state.
+
+
+class FixedPoint:
+    reason = 'fixed point'
+
+    def __init__(self, tol=1e-4, hold=50, min_time=0):
+        # every |dx/dt| [1/ms] of STN, GPe and theta under tol for the last hold ms
+        self.tol = tol
+        self.window = hold
+        self.min_time = min_time
+
+    def __call__(self, x, dt):
+        rate = np.abs(np.diff(x, axis=0)).max(axis=0).max(axis=-1) / dt
+        return (rate <= self.tol) & ((len(x) - 1) * dt >= self.window)
+
+    def extrapolate(self, x, dt, rows):
+        return np.repeat(x[-1:], rows, axis=0)
+
+
+class LimitCycle:
+    reason = 'limit cycle'
+
+    def __init__(self, rtol=1e-3, atol=1e-3, cycles=3, max_period=200, min_time=0):
+        # the last `cycles` periods of STN (between upward crossings of its mean) agree within rtol,
+        # as do the peak-to-peak of STN and GPe and the mean theta over each cycle (within
+        # rtol * value + atol), and their peak-to-peak is not shrinking cycle after cycle, so a slowly
+        # decaying oscillation is not taken for a sustained one.
+        self.rtol = rtol
+        self.atol = atol
+        self.cycles = cycles
+        self.window = (cycles + 1) * max_period
+        self.min_time = min_time
+
+    def _crossings(self, s):
+        # upward crossings of the mean, last cycles + 1 of them: (rows before, fractional rows)
+        mean = s.mean()
+        up = np.flatnonzero((s[:-1] < mean) & (s[1:] >= mean))[-self.cycles - 1:]
+        return up, up + (mean - s[up]) / (s[up + 1] - s[up])
+
+    def __call__(self, x, dt):
+        if x.ndim == 3:
+            return np.array([self(x[:, k], dt) for k in range(x.shape[1])])
+        up, crossings = self._crossings(x[:, 0])
+        if len(up) < self.cycles + 1:
+            return False
+        periods = np.diff(crossings)
+        if np.ptp(periods) > self.rtol * periods.mean():
+            return False
+        cycles = [x[a:b] for a, b in zip(up[:-1], up[1:])]
+        for values in ([np.ptp(c[:, 0]) for c in cycles], [np.ptp(c[:, 1]) for c in cycles]):
+            # beyond rounding, a sustained cycle does not lose amplitude on every cycle
+            if np.all(np.diff(values) < 0) and values[0] - values[-1] > 1e-9 * values[0]:
+                return False
+        for values in ([np.ptp(c[:, 0]) for c in cycles], [np.ptp(c[:, 1]) for c in cycles],
+                       [c[:, 2].mean() for c in cycles]):
+            if np.ptp(values) > self.rtol * np.max(np.abs(values)) + self.atol:
+                return False
+        return True
+
+    def extrapolate(self, x, dt, rows):
+        # x(t) = x(t - period) with the fractional period, interpolated between rows; repeating whole
+        # rows would slip the phase every cycle and leak into band-passed metrics
+        _, crossings = self._crossings(x[:, 0])
+        period = np.diff(crossings).mean()
+        last = len(x) - 1
+        steps = last + 1 + np.arange(rows)
+        source = steps - np.ceil((steps - last) / period) * period
+        return np.stack([np.interp(source, np.arange(len(x)), x[:, k]) for k in range(x.shape[1])], axis=-1)
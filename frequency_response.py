@@ -0,0 +1,119 @@
+import numpy as np
+
+from controller import ZeroController
+from simulation import _time_grid, simulate
+
+# Frequency response of the model to a sinusoidal drive from a single run, instead of one run per
+# frequency as in simulate_figure_2a.py. The drive replaces the oscillation of constants[16:18]
+# (same amplitude, on the channel given by route) and sweeps the frequencies:
+#   'chirp'    logarithmic chirp from the lowest to the highest frequency, sweep_time ms long
+#   'stepped'  one frequency after the other, settle_cycles to settle and cycles to measure each
+#   'multitone' all frequencies at once, each at amplitude / sqrt(len(frequencies)), with Schroeder
+#              phases, scaled back to the full amplitude; a small-signal measurement, the tones also
+#              interact through the sigmoids
+# Amplitudes are peak-to-peak equivalents (twice the amplitude of the component at the drive
+# frequency, by demodulating with the known drive phase), or with metric='ptp' the peak-to-peak of
+# the rate over each frequency's measurement window as in Figure 2a (not for multitone).
+
+
+def _log_chirp(f0, f1, t0, sweep_time):
+    # phase [rad] of a sine at f0 until t0 and then of a logarithmic chirp to f1 at t0 + sweep_time,
+    # and the time the chirp passes each frequency
+    rate = sweep_time / np.log(f1 / f0)
+
+    def phase(t):
+        t = np.asarray(t, dtype=float)
+        chirp = 2 * np.pi * f0 * rate / 1000 * np.expm1(np.clip(t - t0, 0, None) / rate)
+        return chirp + 2 * np.pi * f0 * np.clip(t - t0, None, 0) / 1000
+
+    def time_of(f):
+        return t0 + rate * np.log(f / f0)
+    return phase, time_of
+
+
+def _stepped(frequencies, t0, settle_cycles, cycles):
+    # phase of a stepped sine with continuous phase, each frequency held settle_cycles + cycles
+    # periods from t0 on, and the measurement window of each frequency
+    periods = 1000 / np.asarray(frequencies, dtype=float)
+    starts = t0 + np.concatenate(([0], np.cumsum((settle_cycles + cycles) * periods)))
+    offsets = np.concatenate(([0], np.cumsum(2 * np.pi * (settle_cycles + cycles) * np.ones(len(periods)))))
+
+    def phase(t):
+        t = np.asarray(t, dtype=float)
+        k = np.clip(np.searchsorted(starts, t, side='right') - 1, 0, len(periods) - 1)
+        return offsets[k] + 2 * np.pi * (t - starts[k]) / periods[k]
+    windows = np.stack((starts[:-1] + settle_cycles * periods, starts[1:]), axis=-1)
+    return phase, windows, starts[-1]
+
+
+def _demodulate(y, phase, windows, t):
+    # twice the amplitude of the component of y (rows, channels) in phase with exp(i phase) over
+    # each window
+    out = np.zeros((len(windows), y.shape[1]))
+    for k, (a, b) in enumerate(windows):
+        rows = (t >= a) & (t < b)
+        x = y[rows] - y[rows].mean(axis=0)
+        out[k] = 2 * 2 * np.abs(np.exp(-1j * phase[rows]) @ x) / rows.sum()
+    return out
+
+
+def frequency_response(constants, frequencies, dt, mode='chirp', control_mechanism=None, route='ctx', settle=500,
+                       sweep_time=None, settle_cycles=5, cycles=5, metric='amplitude', init_state=[20, 20, 0],
+                       full_output=False, **simulation_kwargs):
+    # (len(frequencies), 2) STN and GPe response amplitudes at the given frequencies [Hz] from one
+    # run of simulate. The first measurement starts after settle ms, the drive is on from t = 0.
+    # chirp: sweep_time defaults to 10 periods of the lowest frequency per octave; each frequency
+    # is measured over the `cycles` periods centred on the time the chirp passes it.
+    # multitone: the tones are orthogonal over the measurement window of `cycles` periods of their
+    # smallest spacing if they lie on multiples of spacing / cycles.
+    # control_mechanism runs through the whole sweep, so its state carries from one frequency to the
+    # next. full_output=True also returns the history and a dict with the drive phase, the measurement
+    # windows and the number of integration steps.
+    frequencies = np.asarray(frequencies, dtype=float)
+    constants = list(constants)
+    amplitude = constants[16]
+    constants[16] = 0
+    f0, f1 = frequencies.min(), frequencies.max()
+    if mode == 'chirp':
+        if sweep_time is None:
+            sweep_time = 10 * 1000 / f0 * np.log2(f1 / f0)
+        # cycles periods centred on the passage, at the period there
+        half = cycles / 2 * 1000 / frequencies
+        phase, time_of = _log_chirp(f0, f1, settle + half[np.argmin(frequencies)], sweep_time)
+        windows = np.stack((time_of(frequencies) - half, time_of(frequencies) + half), axis=-1)
+        simulation_time = time_of(f1) + half[np.argmax(frequencies)]
+        drive = lambda t: amplitude * np.sin(phase(t))
+    elif mode == 'stepped':
+        phase, windows, simulation_time = _stepped(frequencies, settle, settle_cycles, cycles)
+        drive = lambda t: amplitude * np.sin(phase(t))
+    elif mode == 'multitone':
+        if metric == 'ptp':
+            raise ValueError('metric=ptp needs one frequency at a time')
+        spacing = np.min(np.diff(np.unique(frequencies))) if len(frequencies) > 1 else f0
+        window = cycles * 1000 / spacing
+        k = np.arange(len(frequencies))
+        phases = -np.pi * k * (k + 1) / len(frequencies)
+        tone = amplitude / np.sqrt(len(frequencies))
+        drive = lambda t: tone * np.sin(2 * np.pi * np.multiply.outer(t, frequencies) / 1000 + phases).sum(axis=-1)
+        simulation_time = settle + window
+        windows = np.tile([settle, settle + window], (len(frequencies), 1))
+    else:
+        raise ValueError('Unknown mode: %s' % mode)
+
+    drives = {channel: drive for channel in ('ctx', 'str') if route in (channel, 'both')}
+    history, info = simulate(constants, simulation_time, dt, control_mechanism or ZeroController(),
+                             init_state=init_state, route=route, drives=drives, full_output=True, **simulation_kwargs)
+    start, delta, n_steps = _time_grid(max(constants[6:10]),
+                                       simulation_time + simulation_kwargs.get('steady_state_pad', 0), dt)
+    t = start + np.arange(n_steps) * delta
+    y = history[:, :2]
+    if metric == 'ptp':
+        result = np.array([np.ptp(y[(t >= a) & (t < b)], axis=0) for a, b in windows])
+    elif mode == 'multitone':
+        result = np.array([_demodulate(y, 2 * np.pi * f * t / 1000 + p, [w], t)[0]
+                           for f, p, w in zip(frequencies, phases, windows)]) * amplitude / tone
+    else:
+        result = _demodulate(y, phase(t), windows, t)
+    if not full_output:
+        return result
+    return result, history, {'windows': windows, 'steps': info['steps'], 'time': t}
@@ -0,0 +1,87 @@
+from math import exp
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the kernels then run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# controller kinds understood by euler_kernel
+CONTROLLER_ZERO = 0
+CONTROLLER_PROPORTIONAL = 1
+CONTROLLER_ADAPTIVE = 2
+CONTROLLER_MEMORYLESS = 3
+
+
+@njit(cache=True)
+def _sigmoid(x, m, b):
+    return m / (1 + exp(-4 * x / m) * (m - b) / b)
+
+
+@njit(cache=True)
+def euler_kernel(history, i0, tt, t_first, dt, constants, d11, d12, d21, d22, control_from, ext1, ext2, ctrl_kind,
+                 ctrl_params, ctrl_state, given, control_out):
+    # Advances run rows i0 .. i0 + len(tt) - 1 that lie after t_first. ext1/ext2 are the external
+    # (cortical/striatal) input terms for those rows, already multiplied by cctx/cstr; control is
+    # applied from t >= control_from.
+    # Rows before len(given) are copied from given instead, the controller still sees them.
+    # A non-empty control_out receives the control input of every row.
+    # ctrl_params = [gain, omega, dt, sigma, tau_theta, beta0], ctrl_state = [w]
+    gain = ctrl_params[0]
+    omega = ctrl_params[1]
+    cdt = ctrl_params[2]
+    sigma = ctrl_params[3]
+    tau_theta = ctrl_params[4]
+    beta0 = ctrl_params[5]
+    w = ctrl_state[0]
+
+    # history may be a ring buffer shorter than the run, row i of the run lives at i % n
+    n = history.shape[0]
+    for j in range(len(tt)):
+        t = tt[j]
+        if t <= t_first:
+            continue
+        i = i0 + j
+        prev = (i - 1) % n
+        s0 = history[prev, 0]
+        s1 = history[prev, 1]
+        s2 = history[prev, 2]
+
+        control1 = 0.
+        grad_theta = 0.
+        if ctrl_kind == CONTROLLER_PROPORTIONAL:
+            w += omega * (s0 - w) * cdt
+            control1 = -gain * (s0 - w)
+        elif ctrl_kind == CONTROLLER_ADAPTIVE:
+            control1 = -s2 * (s0 - w)
+            w += omega * (s0 - w) * cdt
+            grad_theta = (abs(s0 - w) - sigma * s2) / tau_theta
+        elif ctrl_kind == CONTROLLER_MEMORYLESS:
+            w += omega * (s0 - w) * cdt
+            control1 = -gain ** 2 * beta0 * s0 - gain * beta0 * s0
+        if t < control_from:
+            control1 = 0.
+            grad_theta = 0.
+        if control_out.shape[0] > 0:
+            control_out[j] = control1
+
+        cur = i % n
+        if i < given.shape[0]:
+            history[cur, 0] = given[i, 0]
+            history[cur, 1] = given[i, 1]
+            history[cur, 2] = given[i, 2]
+            continue
+
+        inputs1 = constants[2] * history[(i - 1 - d11) % n, 0] + \
+            constants[3] * history[(i - 1 - d12) % n, 1] + ext1[j]
+        inputs2 = constants[4] * history[(i - 1 - d21) % n, 0] + \
+            constants[5] * history[(i - 1 - d22) % n, 1] + ext2[j]
+        g0 = 1 / constants[0] * (-s0 + _sigmoid(inputs1 + control1, constants[10], constants[11]))
+        g1 = 1 / constants[1] * (-s1 + _sigmoid(inputs2, constants[12], constants[13]))
+        history[cur, 0] = s0 + g0 * dt
+        history[cur, 1] = s1 + g1 * dt
+        history[cur, 2] = s2 + grad_theta * dt
+
+    ctrl_state[0] = w
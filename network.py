@@ -0,0 +1,128 @@
+import numpy as np
+
+from simulation import _time_grid, drive_waveforms, sigmoid
+
+# N coupled STN/GPe populations. Node k < n is the STN population of pair k, node n + k its GPe
+# population; their time constants, activation functions and external inputs are those of
+# constants (tau, m, b, cctx/cstr, the oscillation and the ctx/str levels), the connections are
+# given as edges (source, target, weight, delay [ms]) arrays, one entry per connection. Every step
+# gathers the delayed rate of each edge's source from a shared ring buffer and adds them up per
+# target, so the cost grows with the number of edges rather than with n ** 2.
+
+
+def join_edges(*edges):
+    # one edge set out of several
+    return tuple(np.concatenate(columns) for columns in zip(*edges))
+
+
+def pair_edges(constants, n):
+    # the four connections of the single-pair model (c11 .. c22, d11 .. d22) within each of n pairs
+    k = np.arange(n)
+    stn, gpe = k, n + k
+    return join_edges(*[(source, target, np.full(n, float(weight)), np.full(n, float(delay)))
+                        for source, target, weight, delay in [(stn, stn, constants[2], constants[6]),
+                                                              (gpe, stn, constants[3], constants[7]),
+                                                              (stn, gpe, constants[4], constants[8]),
+                                                              (gpe, gpe, constants[5], constants[9])]])
+
+
+def _nodes(kind, n):
+    return np.arange(n) if kind == 'stn' else n + np.arange(n)
+
+
+def ring_edges(n, weight, delay, source='gpe', target='stn', neighbours=1):
+    # from the `source` population of every pair to the `target` population of the pairs up to
+    # `neighbours` away on a ring (not the pair itself)
+    offsets = [o for o in range(-neighbours, neighbours + 1) if o != 0]
+    k = np.repeat(np.arange(n), len(offsets))
+    other = (k + np.tile(offsets, n)) % n
+    count = len(k)
+    return (_nodes(source, n)[k], _nodes(target, n)[other], np.full(count, float(weight)),
+            np.full(count, float(delay)))
+
+
+def random_edges(n, k, weight, delay, source='stn', target='gpe', rng=None):
+    # k connections into the `target` population of every pair from the `source` populations of k
+    # other pairs drawn at random; delay may be a (low, high) range drawn uniformly per edge
+    rng = np.random.default_rng(rng)
+    targets = np.repeat(np.arange(n), k)
+    sources = (targets + rng.integers(1, n, size=len(targets))) % n
+    if np.ndim(delay) == 1:
+        delays = rng.uniform(delay[0], delay[1], size=len(targets))
+    else:
+        delays = np.full(len(targets), float(delay))
+    return _nodes(source, n)[sources], _nodes(target, n)[targets], np.full(len(targets), float(weight)), delays
+
+
+def edges_from_sparse(weights, delays):
+    # edges of scipy.sparse (2n, 2n) matrices indexed [target, source]; delays must have the same
+    # sparsity pattern. A matrix holds one connection per (target, source): scipy adds up duplicate
+    # entries, delays included
+    weights = weights.tocoo()
+    delays = delays.tocsr()
+    return (weights.col, weights.row, weights.data.astype(float),
+            np.asarray(delays[weights.row, weights.col]).ravel().astype(float))
+
+
+def simulate_network(constants, n, edges, simulation_time, dt, control_mechanism=None, control_start=200,
+                     stimulated=None, recorded=None, init_state=[20, 20, 40], mid_increase=(750, 0, 0),
+                     route='ctx', drives=None, record_every=1):
+    # Euler integration of n pairs coupled by edges (see above), delays rounded down to whole steps
+    # as in simulate. The controller is stepped with (mean STN rate of the `recorded` pairs, their
+    # mean GPe rate, theta) and its control input reaches the STN populations of the `stimulated`
+    # pairs (index arrays, all pairs by default); it needs a step() method. drives as in simulate,
+    # callables may return one column per pair. Returns (every record_every-th row of the rates,
+    # (rows, n, 2), and theta, (rows,)).
+    source, target, weight, delay = (np.asarray(column) for column in edges)
+    nodes = 2 * n
+    steps = np.floor(delay / dt).astype(int)
+    max_delay = max(float(delay.max()) if len(delay) else 0, max(constants[6:10]))
+    start, delta, n_steps = _time_grid(max_delay, simulation_time, dt)
+    length = max(min(int(steps.max() if len(steps) else 0) + 2, n_steps), 1)
+
+    buffer = np.zeros((length, nodes))
+    buffer[:, :n] = init_state[0]
+    buffer[:, n:] = init_state[1]
+    theta = init_state[2]
+    stimulated = np.arange(n) if stimulated is None else np.asarray(stimulated)
+    recorded = np.arange(n) if recorded is None else np.asarray(recorded)
+    step = None
+    if control_mechanism is not None:
+        step = getattr(control_mechanism, 'step', None)
+        if step is None:
+            raise ValueError('simulate_network needs a controller with a step() method')
+
+    rows = np.arange(0, n_steps, record_every)
+    history = np.zeros((len(rows), n, 2))
+    thetas = np.zeros(len(rows))
+    r0 = 1 / constants[0]
+    r1 = 1 / constants[1]
+    m1, b1, m2, b2 = constants[10:14]
+    control_from = control_start
+
+    tt = start + np.arange(n_steps) * delta
+    ctx_input, str_input, _ = drive_waveforms(constants, tt[:, np.newaxis], mid_increase, 0, route, drives)
+    ext1 = np.broadcast_to(constants[14] * ctx_input, (n_steps, n))
+    ext2 = np.broadcast_to(constants[15] * str_input, (n_steps, n))
+    stimulus = np.zeros(n)
+    record = 0
+    for i, t in enumerate(tt.tolist()):
+        if t > 0:
+            state = buffer[(i - 1) % length]
+            control1, grad_theta = 0, 0
+            if step is not None:
+                control1, grad_theta = step((state[recorded].mean(), state[n + recorded].mean(), theta), t)
+                if t < control_from:
+                    control1, grad_theta = (0, 0)
+            synaptic = np.bincount(target, weight * buffer[(i - 1 - steps) % length, source], minlength=nodes)
+            stimulus[stimulated] = control1
+            buffer[i % length, :n] = state[:n] + r0 * (-state[:n] + sigmoid(synaptic[:n] + ext1[i] + stimulus, m1,
+                                                                                 b1)) * dt
+            buffer[i % length, n:] = state[n:] + r1 * (-state[n:] + sigmoid(synaptic[n:] + ext2[i], m2, b2)) * dt
+            theta = theta + grad_theta * dt
+        if record < len(rows) and rows[record] == i:
+            history[record, :, 0] = buffer[i % length, :n]
+            history[record, :, 1] = buffer[i % length, n:]
+            thetas[record] = theta
+            record += 1
+    return history, thetas
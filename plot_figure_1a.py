@@ -1,16 +1,13 @@
-import pathlib
-import pickle
-
 import matplotlib.pyplot as plt
 import numpy as np
 
+from result_store import ResultStore
+
 if __name__ == '__main__':
-    fpath = pathlib.Path('simulation_results/results_figure_1a')
-    with open(fpath, 'rb') as results_file:
-        res = pickle.load(results_file)
+    res = ResultStore('simulation_results/figure_1a')
     stn_amplitude = res['stn']
     gpe_amplitude = res['gpe']
-    constants = res['constants']
+    constants = res.attrs()['constants']
     c12_range = res['c12_range']
     c21_range = res['c21_range']
 
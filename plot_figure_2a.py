@@ -1,9 +1,8 @@
-import pathlib
-import pickle
-
 import matplotlib.pyplot as plt
 import numpy as np
 
+from result_store import ResultStore
+
 
 def single_plot(ax, f_range, ctx_range, data, input_amplitude, plot_color, alphas, grays, plot_loglog=True):
     leg = []
@@ -49,13 +48,10 @@ if __name__ == "__main__":
     input_amplitude = 10
     plot_color = False
 
-    p = pathlib.Path('simulation_results/results_figure_2a')
-
-    with open(p, 'rb') as results_file:
-        res = pickle.load(results_file)
-        stn_amplidute = res['stn']
-        gpe_amplidute = res['gpe']
-        f_range = res['f_range']
+    res = ResultStore('simulation_results/figure_2a')
+    stn_amplidute = res['stn']
+    gpe_amplidute = res['gpe']
+    f_range = res['f_range']
     ctx_range = np.array([10, 22])
     alphas = [0.6, 1]
     grays = ['0.5', '0.1']
@@ -1,20 +1,24 @@
 import math
-import pickle
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from analysis import sliding_ptp
+from result_store import ResultStore
+
 
 def plot_controller_comparison(filename, prefix, ylim=None):
-    with open(filename, 'rb') as f:
-        res = pickle.load(f)
+    store = ResultStore(filename)
+    attrs = store.attrs()
 
-    constants = res['constants']
+    constants = attrs['constants']
     max_delay = max(constants[6:10])
-    simulation_time = res['simulation_time']
-    dt = res['dt']
+    simulation_time = attrs['simulation_time']
+    dt = attrs['dt']
     timestop = simulation_time
     ts = math.floor((max_delay + timestop) / dt)
+    # only the plotted rows are read from disk
+    res = {name: store.load(name, 0, ts) for name in ['proportional', 'adaptive']}
     tt = np.arange(-max_delay, timestop, dt) / 1000
 
     fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True)
@@ -63,8 +67,8 @@ def plot_controller_comparison(filename, prefix, ylim=None):
 
     x0 = res['proportional'][:ts, 0]
     x1 = res['proportional'][:ts, 1]
-    ia0 = np.array([np.ptp(x0[i:i + ialen]) for i in range(ts - ialen)])
-    ia1 = np.array([np.ptp(x1[i:i + ialen]) for i in range(ts - ialen)])
+    ia0 = sliding_ptp(x0, ialen)[:ts - ialen]
+    ia1 = sliding_ptp(x1, ialen)[:ts - ialen]
     ax7.set_title('Instantaneous amplitude; proportional control')
     ax7.plot(tt, ia0)
     ax7.plot(tt, ia1)
@@ -76,8 +80,8 @@ def plot_controller_comparison(filename, prefix, ylim=None):
         ax7.set_ylim(ylim[1])
     x0 = res['adaptive'][:ts, 0]
     x1 = res['adaptive'][:ts, 1]
-    ia0 = np.array([np.ptp(x0[i:i + ialen]) for i in range(ts - ialen)])
-    ia1 = np.array([np.ptp(x1[i:i + ialen]) for i in range(ts - ialen)])
+    ia0 = sliding_ptp(x0, ialen)[:ts - ialen]
+    ia1 = sliding_ptp(x1, ialen)[:ts - ialen]
     ax8.set_title('Instantaneous amplitude; self-tuning control')
     ax8.plot(tt, ia0)
     ax8.plot(tt, ia1)
@@ -94,5 +98,5 @@ def plot_controller_comparison(filename, prefix, ylim=None):
 
 
 if __name__ == '__main__':
-    plot_controller_comparison('simulation_results/results_figure_3', 'figure3', ylim=[[5, 99], [-1, 61]])
-    plot_controller_comparison('simulation_results/results_figure_4', 'figure4', ylim=[[0, 300], [-1, 280]])
+    plot_controller_comparison('simulation_results/figure_3', 'figure3', ylim=[[5, 99], [-1, 61]])
+    plot_controller_comparison('simulation_results/figure_4', 'figure4', ylim=[[0, 300], [-1, 280]])
@@ -0,0 +1,72 @@
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    # Instrumentation for simulate(profile=...): wall time per phase of the engine, counters and
+    # callbacks after every block of steps. Phases are 'setup', 'inputs' (drive waveforms), 'loop' (the
+    # Python step loop, controller calls included), 'controller', 'kernel' (compiled steps, controller
+    # included), 'convergence', 'callbacks' and 'output'. callbacks are called as
+    # callback(profiler, i0, i1, history) after rows i0 .. i1 - 1 were written. Without a profiler
+    # simulate takes none of these timings.
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.controller = None
+        self._phase = None
+
+    def start(self, phase):
+        self._phase = phase, time.perf_counter()
+
+    def stop(self):
+        phase, t0 = self._phase
+        self.times[phase] += time.perf_counter() - t0
+        self._phase = None
+
+    def switch(self, phase):
+        self.stop()
+        self.start(phase)
+
+    def count(self, name, k=1):
+        self.counts[name] += k
+
+    def timed(self, name, function):
+        # function, timing and counting its calls under name
+        if function is None:
+            return None
+
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.times[name] += time.perf_counter() - t0
+                self.counts[name] += 1
+        return wrapper
+
+    def block(self, i0, i1, history):
+        self.count('blocks')
+        if self.callbacks:
+            self.switch('callbacks')
+        for callback in self.callbacks:
+            callback(self, i0, i1, history)
+
+    def summary(self):
+        # times [s] per phase, with the step loop split into controller and dynamics, counters, and
+        # steps/s and controller overhead per call [s] and as a fraction of the stepping time
+        times = dict(self.times)
+        if 'loop' in times:
+            times['dynamics'] = times.pop('loop') - times.get('controller', 0)
+        steps = self.counts.get('steps', 0)
+        stepping = times.get('dynamics', 0) + times.get('controller', 0) + times.get('kernel', 0)
+        calls = self.counts.get('controller', 0)
+        return {
+            'controller': self.controller,
+            'times': times,
+            'counts': dict(self.counts),
+            'total': sum(times.values()),
+            'steps_per_second': steps / stepping if stepping > 0 else None,
+            'controller_per_call': times['controller'] / calls if calls else None,
+            'controller_fraction': times.get('controller', 0) / stepping if stepping > 0 else None,
+        }
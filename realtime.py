@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+
+
+class Pacer:
+    # Real-time pacing for simulate(realtime=...): the controller runs at sample_rate [Hz] of
+    # simulated time, every k = 1000 / (sample_rate * dt) integration steps with its output held in
+    # between (1000 / dt, every step, by default; construct it with k * dt as its dt), and each of
+    # its calls is released at its own tick of a wall clock at the same rate, so the plant runs in
+    # real time. The time a call takes is checked against a budget [s] (the sample period by
+    # default). Per call it records the latency (release to return), the release
+    # lateness (how far behind its tick the call started, the jitter of the loop: plant steps
+    # and earlier overruns push the next release back) and a deadline miss when the controller
+    # returns later than its tick + budget. The schedule is absolute, a late loop catches up
+    # instead of drifting. Sleeps until spin [s] before the tick and busy-waits for the rest.
+    def __init__(self, sample_rate=None, budget=None, spin=2e-3):
+        self.sample_rate = sample_rate
+        self.budget = budget
+        self.spin = spin
+        self.controller = None
+        self.period = None
+        self.every = None
+        self.latency = []
+        self.lateness = []
+        self._origin = None
+
+    def start(self, dt):
+        if self.sample_rate is None:
+            self.sample_rate = 1000 / dt
+        self.every = int(round(1000 / (self.sample_rate * dt)))
+        if self.every < 1 or abs(self.every * dt * self.sample_rate / 1000 - 1) > 1e-9:
+            raise ValueError('sample_rate must be 1000 / (k * dt) for a whole number of steps k')
+        self.period = self.every * dt / 1000
+        if self.budget is None:
+            self.budget = self.period
+        self.latency = []
+        self.lateness = []
+        self._origin = None
+        self._calls = 0
+        self._held = (0, 0)
+
+    def _wait(self, tick):
+        while True:
+            left = tick - time.perf_counter()
+            if left <= 0:
+                return
+            if left > self.spin:
+                time.sleep(left - self.spin)
+
+    def paced(self, function):
+        # function, called every `every` steps on the next tick and timed, its last output held
+        # in between
+        if function is None:
+            return None
+
+        def wrapper(*args, **kwargs):
+            call = self._calls
+            self._calls += 1
+            if call % self.every:
+                return self._held
+            if self._origin is None:
+                self._origin = time.perf_counter()
+            tick = self._origin + len(self.latency) * self.period
+            self._wait(tick)
+            t0 = time.perf_counter()
+            try:
+                self._held = function(*args, **kwargs)
+                return self._held
+            finally:
+                t1 = time.perf_counter()
+                self.latency.append(t1 - t0)
+                self.lateness.append(t0 - tick)
+        return wrapper
+
+    def summary(self):
+        # sample rate [Hz], period and budget [s], latency and release lateness statistics [s],
+        # deadline misses and the per-call arrays
+        latency = np.asarray(self.latency)
+        lateness = np.asarray(self.lateness)
+        missed = lateness + latency > self.budget
+
+        def stats(x):
+            if not len(x):
+                return None
+            return {'mean': x.mean(), 'std': x.std(), 'p50': np.percentile(x, 50), 'p99': np.percentile(x, 99),
+                    'max': x.max()}
+        return {
+            'controller': self.controller,
+            'sample_rate': self.sample_rate,
+            'every': self.every,
+            'period': self.period,
+            'budget': self.budget,
+            'calls': len(latency),
+            'latency': stats(latency),
+            'lateness': stats(lateness),
+            'misses': int(missed.sum()),
+            'miss_fraction': missed.mean() if len(missed) else 0.0,
+            'utilization': latency.mean() / self.period if len(latency) else 0.0,
+            'latencies': latency,
+            'latenesses': lateness,
+            'missed': missed,
+        }
+
+
+def certify(summary, max_miss_fraction=0):
+    # whether a paced run met its budget: no more than max_miss_fraction of the calls late
+    return summary['calls'] > 0 and summary['miss_fraction'] <= max_miss_fraction
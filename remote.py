@@ -0,0 +1,191 @@
+import multiprocessing as mp
+import os
+import traceback
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Controllers run in a separate process, fed through single-producer single-consumer rings in shared
+# memory: the simulation writes (state, t) samples into one ring, the controller process writes
+# (control, grad_theta) into the other. Each side only ever advances its own counter after writing
+# the slot it covers, so neither ring takes a lock; both sides poll, yielding the CPU after `spin`
+# empty polls so the two processes can also share one core. Every slot ends in a sequence word,
+# cleared before its data is written and set to k + 1 after, and the reader takes row k only if the
+# word reads k + 1 both before and after copying the data, which catches a slot read while it is
+# being written as long as the other process sees the stores in program order. Nothing here enforces
+# that order: neither NumPy nor CPython puts a memory fence between these stores and loads. It holds
+# on x86, which keeps stores (and loads) in order; elsewhere correctness relies on the barriers the
+# interpreter happens to execute between the statements (its atomic operations, e.g. around the GIL).
+
+_SAMPLES, _OUTPUTS, _STOP, _ERROR = range(4)
+
+
+def _views(buf, capacity):
+    counters = np.ndarray((4,), dtype=np.int64, buffer=buf)
+    samples = np.ndarray((capacity, 6), dtype=np.float64, buffer=buf, offset=counters.nbytes)
+    outputs = np.ndarray((capacity, 3), dtype=np.float64, buffer=buf, offset=counters.nbytes + samples.nbytes)
+    return counters, samples, outputs
+
+
+def _write(ring, k, values):
+    # row k into its slot, the sequence word last
+    slot = ring[k % len(ring)]
+    slot[-1] = 0
+    slot[:-1] = values
+    slot[-1] = k + 1
+
+
+def _read(ring, k):
+    # a copy of row k, or None while its slot does not hold all of it
+    slot = ring[k % len(ring)]
+    if slot[-1] != k + 1:
+        return None
+    row = slot[:-1].copy()
+    return row if slot[-1] == k + 1 else None
+
+
+def _serve(name, capacity, controller, spin, conn):
+    # controller process: step the controller on every sample until stopped, then send it back.
+    # Controllers without step() are called with the samples received so far (the last `window`
+    # of them for windowed controllers); history-only samples are just added to those.
+    shm = SharedMemory(name)
+    counters, samples, outputs = _views(shm.buf, capacity)
+    try:
+        step = getattr(controller, 'step', None)
+        rows = deque(maxlen=getattr(controller, 'window', None))
+        k = 0
+        polls = 0
+        while True:
+            row = _read(samples, k) if counters[_SAMPLES] > k else None
+            if row is None:
+                if counters[_STOP] and counters[_SAMPLES] <= k:
+                    break
+                polls += 1
+                if polls > spin:
+                    os.sched_yield()
+                continue
+            polls = 0
+            state, t, history_only = row[:3], row[3], row[4]
+            control, grad_theta = np.nan, np.nan
+            if step is not None:
+                if not history_only:
+                    control, grad_theta = step(state, t)
+            else:
+                rows.append(state)
+                if not history_only:
+                    control, grad_theta = controller(np.array(rows))
+            _write(outputs, k, (control, grad_theta))
+            k += 1
+            counters[_OUTPUTS] = k
+        conn.send(controller)
+    except BaseException:
+        counters[_ERROR] = 1
+        conn.send(traceback.format_exc())
+    finally:
+        del counters, samples, outputs
+        shm.close()
+        conn.close()
+
+
+class RemoteController:
+    # Runs control_mechanism (scalar outputs) in another process and looks like a step() controller
+    # to simulate. delay=0 is lockstep: each call waits for the controller's answer to its own
+    # sample. delay=1 returns the answer to the previous sample ((0, 0) on the first call), so the
+    # controller works on sample k while the simulation integrates the next step, as on a device
+    # whose output lags its input by one sample period. Use as a context manager or call close(),
+    # which stops the process and replaces self.controller by its final state.
+    # Called with the history (simulate with keep_history=True), the rows before the first call
+    # are passed on too, so controllers without step() see the same history as when run inline.
+    # spin defaults to 0 on a single core, where polling only delays the other process.
+    def __init__(self, control_mechanism, delay=0, capacity=64, spin=None):
+        if delay not in (0, 1):
+            raise ValueError('delay must be 0 or 1')
+        self.controller = control_mechanism
+        self.delay = delay
+        self.capacity = max(capacity, delay + 1)
+        self.spin = (0 if os.cpu_count() == 1 else 1000) if spin is None else spin
+        self.sent = 0
+        self.previous = None
+        self.shm = SharedMemory(create=True, size=4 * 8 + self.capacity * 9 * 8)
+        self.counters, self.samples, self.outputs = _views(self.shm.buf, self.capacity)
+        self.counters[:] = 0
+        self.conn, child = mp.Pipe(duplex=False)
+        self.process = mp.Process(target=_serve, args=(self.shm.name, self.capacity, control_mechanism, self.spin, child),
+                                  daemon=True)
+        self.process.start()
+        child.close()
+
+    def _wait(self, index, value, ring=None):
+        # until counters[index] reaches value; with a ring, returns a copy of its row value - 1
+        polls = 0
+        while True:
+            if self.counters[index] >= value:
+                if ring is None:
+                    return None
+                row = _read(ring, value - 1)
+                if row is not None:
+                    return row
+            if self.counters[_ERROR]:
+                raise RuntimeError('controller process failed:\n%s' % self.conn.recv())
+            polls += 1
+            if polls > self.spin:
+                if not self.process.is_alive() and self.counters[index] < value:
+                    raise RuntimeError('controller process exited')
+                os.sched_yield()
+
+    def _send(self, state, t, history_only):
+        k = self.sent
+        # the ring must not overrun answers that have not been read yet
+        self._wait(_OUTPUTS, k + 1 - self.capacity)
+        _write(self.samples, k, (state[0], state[1], state[2], np.nan if t is None else t, history_only))
+        self.sent = k + 1
+        self.counters[_SAMPLES] = self.sent
+        return k
+
+    def step(self, state, t=None):
+        k = self._send(state, t, 0)
+        answer = k if self.delay == 0 else self.previous
+        self.previous = k
+        if answer is None:
+            return 0, 0
+        control, grad_theta = self._wait(_OUTPUTS, answer + 1, self.outputs)
+        return float(control), float(grad_theta)
+
+    def __call__(self, history):
+        if self.sent == 0:
+            for row in history[:-1]:
+                self._send(row, None, 1)
+        return self.step(history[-1])
+
+    def close(self):
+        if self.process is None:
+            return
+        self.counters[_STOP] = 1
+        result = None
+        try:
+            # read before joining, the process cannot exit while the pipe is full
+            while self.process.is_alive() or self.conn.poll():
+                if self.conn.poll(0.1):
+                    try:
+                        result = self.conn.recv()
+                    except EOFError:
+                        pass
+                    break
+            self.process.join()
+        finally:
+            self.conn.close()
+            self.process = None
+            del self.counters, self.samples, self.outputs
+            self.shm.close()
+            self.shm.unlink()
+        if isinstance(result, str):
+            raise RuntimeError('controller process failed:\n%s' % result)
+        if result is not None:
+            self.controller = result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
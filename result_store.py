@@ -0,0 +1,132 @@
+import json
+import os
+
+import numpy as np
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Cannot store %r as an attribute' % (value,))
+
+
+class ResultStore:
+    # A directory of .npy segments plus an append-only JSON-lines index. A dataset is the
+    # concatenation (along axis 0) of its segments: appending writes one new segment and one
+    # index line, nothing is rewritten. Reads go through memory maps, so loading part of a long
+    # trajectory only touches the rows that are used. A crash mid-append leaves at most a
+    # truncated last index line, which is ignored.
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._index = os.path.join(path, 'index.jsonl')
+        self._segments = {}
+        self._counter = {}
+        self._attrs = {}
+        if os.path.exists(self._index):
+            end = 0
+            with open(self._index, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    self._apply(entry)
+                    end += len(line)
+            if end < os.path.getsize(self._index):
+                # drop a line cut short by a crash so later appends stay readable
+                with open(self._index, 'r+b') as f:
+                    f.truncate(end)
+
+    def _apply(self, entry):
+        kind = entry['kind']
+        if kind == 'append':
+            for name, file, rows in entry['segments']:
+                self._segments.setdefault(name, []).append((file, rows))
+                self._counter[name] = self._counter.get(name, 0) + 1
+        elif kind == 'reset':
+            self._segments[entry['name']] = []
+        elif kind == 'attrs':
+            self._attrs.setdefault(entry['name'], {}).update(entry['attrs'])
+
+    def _log(self, entry):
+        line = json.dumps(entry, default=_to_json)
+        with open(self._index, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._apply(entry)
+
+    def _write_segment(self, name, data):
+        file = '%s.%06d.npy' % (name, self._counter.get(name, 0))
+        tmp = os.path.join(self.path, file + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, os.path.join(self.path, file))
+        return [name, file, len(data) if data.ndim else 1]
+
+    def append(self, name, data):
+        self.append_many({name: data})
+
+    def append_many(self, datasets):
+        # one segment per dataset, committed together by a single index line
+        segments = [self._write_segment(name, np.asarray(data)) for name, data in datasets.items()]
+        self._log({'kind': 'append', 'segments': segments})
+
+    def put(self, name, data, **attrs):
+        # replaces the dataset with a single segment
+        old = self._segments.get(name, [])
+        self._log({'kind': 'reset', 'name': name})
+        self.append(name, data)
+        for file, _ in old:
+            os.remove(os.path.join(self.path, file))
+        if attrs:
+            self.set_attrs(name, **attrs)
+
+    def set_attrs(self, name='', **attrs):
+        # JSON-serialisable metadata, per dataset or for the whole store (name='')
+        self._log({'kind': 'attrs', 'name': name, 'attrs': attrs})
+
+    def attrs(self, name=''):
+        return dict(self._attrs.get(name, {}))
+
+    def names(self):
+        return [name for name, segments in self._segments.items() if segments]
+
+    def __contains__(self, name):
+        return bool(self._segments.get(name))
+
+    def __len__(self):
+        return len(self.names())
+
+    def rows(self, name):
+        return sum(rows for _, rows in self._segments.get(name, []))
+
+    def segments(self, name):
+        return [np.load(os.path.join(self.path, file), mmap_mode='r') for file, _ in self._segments[name]]
+
+    def load(self, name, start=None, stop=None):
+        # rows [start, stop) of a dataset, reading only the segments that overlap them;
+        # a single-segment dataset comes back as a memory map
+        if name not in self:
+            raise KeyError(name)
+        start, stop, _ = slice(start, stop).indices(self.rows(name))
+        parts = []
+        offset = 0
+        for file, rows in self._segments[name]:
+            if offset + rows > start and offset < stop:
+                data = np.load(os.path.join(self.path, file), mmap_mode='r')
+                if data.ndim == 0:
+                    return data[()]
+                parts.append(data[max(start - offset, 0):stop - offset])
+            offset += rows
+        if not parts:
+            return self.segments(name)[0][:0]
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def __getitem__(self, name):
+        return self.load(name)
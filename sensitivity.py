@@ -0,0 +1,168 @@
+from math import floor
+
+import numpy as np
+
+import controller as ctrl
+from analysis import bandpass, decimate
+from simulation import _time_grid, drive_waveforms, sigmoid
+
+# Forward sensitivities of the Euler scheme of simulate: alongside the state, one run integrates
+# S_i = d(STN, GPe, theta)_i / dp for every parameter p, differentiating each Euler step exactly
+# (delays stay whole steps, so S at the delayed rows enters like the delayed states do). Parameters
+# are indices into constants (taus 0-1, weights 2-5, sigmoids 10-13, cctx/cstr 14-15) or names of
+# controller attributes: 'gain', 'omega', 'sigma', 'tau_theta' and, for MemoryLessController,
+# 'beta' (betas[0]). The costs below return (value, gradient over the parameters).
+
+_CONSTANTS = [0, 1, 2, 3, 4, 5, 10, 11, 12, 13, 14, 15]
+
+
+def _sigmoid_partials(x, m, b):
+    # d sigmoid / d (x, m, b)
+    e = np.exp(-4 * x / m)
+    k = (m - b) / b
+    d = 1 + e * k
+    dx = 4 * e * k / d ** 2
+    dm = 1 / d - m / d ** 2 * (k * e * 4 * x / m ** 2 + e / b)
+    db = m ** 2 * e / (b ** 2 * d ** 2)
+    return dx, dm, db
+
+
+def _controller_partials(control_mechanism, state, w):
+    # partial derivatives of one step of a step() controller with state w, before the step:
+    # ((du/dstate, du/dw, du/dparams), (dg/dstate, dg/dw, dg/dparams), (dw'/dstate, dw'/dw, dw'/dparams)),
+    # g the theta gradient and w' the new state, params as dicts by name
+    s0, s1, s2 = state
+    zero = np.zeros(3)
+    if type(control_mechanism) is ctrl.ZeroController:
+        return (zero, 0, {}), (zero, 0, {}), (zero, 1, {})
+    omega, dt = control_mechanism.omega, control_mechanism.dt
+    w_new = w + omega * (s0 - w) * dt
+    dw = (np.array([omega * dt, 0, 0]), 1 - omega * dt, {'omega': (s0 - w) * dt})
+    if type(control_mechanism) is ctrl.MemoryLessController:
+        gain, beta = control_mechanism.gain, control_mechanism.betas[0]
+        du = (np.array([-(gain ** 2 + gain) * beta, 0, 0]), 0,
+              {'gain': -(2 * gain + 1) * beta * s0, 'beta': -(gain ** 2 + gain) * s0})
+        return du, (zero, 0, {}), dw
+    if type(control_mechanism) is ctrl.ProportionalController:
+        gain = control_mechanism.gain
+        du = (-gain * (np.array([1, 0, 0]) - dw[0]), gain * dw[1], {'gain': -(s0 - w_new), 'omega': gain * dw[2]['omega']})
+        return du, (zero, 0, {}), dw
+    if type(control_mechanism) is ctrl.AdaptiveController:
+        sigma, tau_theta = control_mechanism.sigma, control_mechanism.tau_theta
+        du = (np.array([-s2, 0, -(s0 - w)]), s2, {})
+        error = s0 - w_new
+        sign = np.sign(error)
+        g = (abs(error) - sigma * s2) / tau_theta
+        dg = ((sign * (np.array([1, 0, 0]) - dw[0]) - np.array([0, 0, sigma])) / tau_theta, -sign * dw[1] / tau_theta,
+              {'omega': -sign * dw[2]['omega'] / tau_theta, 'sigma': -s2 / tau_theta, 'tau_theta': -g / tau_theta})
+        return du, dg, dw
+    raise ValueError('No sensitivities for %s' % type(control_mechanism).__name__)
+
+
+def _vector(partials, params):
+    return np.array([partials.get(p, 0) if isinstance(p, str) else 0 for p in params], dtype=float)
+
+
+def simulate_sensitivities(constants, simulation_time, dt, control_mechanism, params, control_start=200,
+                           init_state=[20, 20, 40], mid_increase=(750, 0, 0), steady_state_pad=0, route='ctx',
+                           drives=None):
+    # simulate(..., backend='python') of the same arguments, plus the sensitivities of every row to
+    # params, (n_steps, 3, len(params)). Controllers: Zero, Proportional, Adaptive and MemoryLess, not
+    # their subclasses, whose step() may differ.
+    # info holds the applied control input and its sensitivities ('control', 'control_sensitivity')
+    # and the times of the rows.
+    for p in params:
+        if not isinstance(p, str) and p not in _CONSTANTS:
+            raise ValueError('constants[%d] is not differentiable (delays and drive parameters are not)' % p)
+    P = len(params)
+    max_delay = max(constants[6:10])
+    start, delta, n_steps = _time_grid(max_delay, simulation_time + steady_state_pad, dt)
+    hlen = int(floor(max_delay / dt))
+    history = np.zeros((n_steps, 3))
+    history[0:hlen + 1] = init_state
+    S = np.zeros((n_steps, 3, P))
+    control = np.zeros(n_steps)
+    control_sensitivity = np.zeros((n_steps, P))
+    d11, d12, d21, d22 = (int(floor(d / dt)) for d in constants[6:10])
+    control_from = control_start + steady_state_pad
+    tau1, tau2 = constants[0:2]
+    r0, r1 = 1 / tau1, 1 / tau2
+    c2, c3, c4, c5 = constants[2:6]
+    m1, b1, m2, b2 = constants[10:14]
+
+    def unit(index):
+        return np.array([1.0 if p == index else 0.0 for p in params])
+    e = {k: unit(k) for k in _CONSTANTS}
+
+    tt = start + np.arange(n_steps) * delta
+    ctx_input, str_input, _ = drive_waveforms(constants, tt, mid_increase, steady_state_pad, route, drives)
+    ext1 = constants[14] * ctx_input
+    ext2 = constants[15] * str_input
+    step = control_mechanism.step
+    w = control_mechanism.w
+    Sw = np.zeros(P)
+    for i, t in enumerate(tt.tolist()):
+        if t <= 0:
+            continue
+        state = history[i - 1]
+        Si = S[i - 1]
+        (du_x, du_w, du_p), (dg_x, dg_w, dg_p), (dw_x, dw_w, dw_p) = _controller_partials(control_mechanism, state, w)
+        control1, grad_theta = step(state, t)
+        dU = du_x @ Si + du_w * Sw + _vector(du_p, params)
+        dG = dg_x @ Si + dg_w * Sw + _vector(dg_p, params)
+        Sw = dw_x @ Si + dw_w * Sw + _vector(dw_p, params)
+        w = control_mechanism.w
+        if t < control_from:
+            control1, grad_theta = (0, 0)
+            dU = dG = np.zeros(P)
+        control[i] = control1
+        control_sensitivity[i] = dU
+
+        s0, s1, s2 = state
+        x11, x12 = history[i - 1 - d11, 0], history[i - 1 - d12, 1]
+        x21, x22 = history[i - 1 - d21, 0], history[i - 1 - d22, 1]
+        inputs1 = c2 * x11 + c3 * x12 + ext1[i]
+        inputs2 = c4 * x21 + c5 * x22 + ext2[i]
+        z1 = inputs1 + control1
+        f1, f2 = sigmoid(z1, m1, b1), sigmoid(inputs2, m2, b2)
+        history[i] = (s0 + r0 * (-s0 + f1) * dt,
+                      s1 + r1 * (-s1 + f2) * dt,
+                      s2 + grad_theta * dt)
+
+        f1_x, f1_m, f1_b = _sigmoid_partials(z1, m1, b1)
+        f2_x, f2_m, f2_b = _sigmoid_partials(inputs2, m2, b2)
+        dz1 = c2 * S[i - 1 - d11, 0] + c3 * S[i - 1 - d12, 1] + e[2] * x11 + e[3] * x12 + e[14] * ctx_input[i] + dU
+        dz2 = c4 * S[i - 1 - d21, 0] + c5 * S[i - 1 - d22, 1] + e[4] * x21 + e[5] * x22 + e[15] * str_input[i]
+        S[i, 0] = Si[0] + (-e[0] / tau1 ** 2 * (-s0 + f1)
+                           + r0 * (-Si[0] + f1_x * dz1 + f1_m * e[10] + f1_b * e[11])) * dt
+        S[i, 1] = Si[1] + (-e[1] / tau2 ** 2 * (-s1 + f2)
+                           + r1 * (-Si[1] + f2_x * dz2 + f2_m * e[12] + f2_b * e[13])) * dt
+        S[i, 2] = Si[2] + dG * dt
+    return history, S, {'control': control, 'control_sensitivity': control_sensitivity, 'time': tt,
+                        'params': list(params)}
+
+
+def beta_amplitude(history, sensitivities, dt, band=(13, 30), tail_len=1000, div=10, metric='rms', channel=0):
+    # beta-band amplitude of the STN (channel 0) or GPe rate over the last tail_len ms, after
+    # decimating by div and band-passing as analysis.band_amplitude, and its gradient. 'rms' is
+    # 2 sqrt(2) times the RMS (the peak-to-peak of a sinusoid) and smooth; 'ptp' is the peak-to-peak
+    # of band_amplitude, with the gradient taken at the extrema.
+    x = np.concatenate((history[:, channel, np.newaxis], sensitivities[:, channel]), axis=1)
+    y = bandpass(decimate(x, div, axis=0), band, 1000 / (div * dt), axis=0)
+    y = y[-max(1, int(tail_len / (div * dt))):]
+    if metric == 'ptp':
+        hi, lo = np.argmax(y[:, 0]), np.argmin(y[:, 0])
+        return y[hi, 0] - y[lo, 0], y[hi, 1:] - y[lo, 1:]
+    rms = np.sqrt(np.mean(y[:, 0] ** 2))
+    return 2 * np.sqrt(2) * rms, 2 * np.sqrt(2) * np.mean(y[:, :1] * y[:, 1:], axis=0) / rms
+
+
+def control_energy(info, dt, tail_len=None):
+    # integral of the squared control input (over the last tail_len ms) and its gradient
+    rows = slice(None) if tail_len is None else slice(-max(1, int(tail_len / dt)), None)
+    u, du = info['control'][rows], info['control_sensitivity'][rows]
+    return np.sum(u ** 2) * dt, 2 * (u @ du) * dt
+
+
+def final_theta(history, sensitivities):
+    return history[-1, 2], sensitivities[-1, 2]
@@ -0,0 +1,47 @@
+from functools import partial
+
+import controller as ctrl
+import simulation as sim
+from autotune import TuningObjective, successive_halving
+from result_store import ResultStore
+
+if __name__ == '__main__':
+    # tunes the Figure 3 controllers (hand-picked there as sigma = 0.19, tau_theta = 75 and
+    # prop_theta = 2) by successive halving, each rung batched through a controller bank
+    constants = sim.constants_nevado_holgado_healthy
+    constants[3] = -3
+    constants[4] = 10
+    constants[5] = -0.9
+    constants[14] = 5
+    constants[15] = -139.4
+
+    dt = 0.05
+    mi = (750, 15, 0)
+    it = [20, 20, 0]
+    n = 81
+    eta = 3
+    min_time = 1000
+    max_time = 3000
+    weights = (1, 1, 1e-3)
+
+    store = ResultStore('simulation_results/autotune')
+    for name, bank, space in [
+        ('adaptive', partial(ctrl.AdaptiveControllerBank, dt=dt),
+         {'sigma': (0.01, 1, 'log'), 'tau_theta': (5, 300, 'log'), 'omega': (0.01, 1, 'log')}),
+        ('proportional', partial(ctrl.ProportionalControllerBank, dt=dt),
+         {'gain': (0.1, 30, 'log'), 'omega': (0.001, 0.1, 'log')}),
+    ]:
+        objective = TuningObjective(constants, dt, bank=bank, init_state=it, mid_increase=mi, weights=weights)
+        best, cost, rungs = successive_halving(objective, space, n=n, eta=eta, min_time=min_time, max_time=max_time,
+                                               rng=0)
+        print(name, best, 'cost %.3f' % cost, '%d runs' % objective.evaluations)
+        for k, rung in enumerate(rungs):
+            for key, values in rung['params'].items():
+                store.put('%s.rung_%d.%s' % (name, k, key), values)
+            store.put('%s.rung_%d.costs' % (name, k), rung['costs'])
+            for key, values in rung['parts'].items():
+                store.put('%s.rung_%d.%s' % (name, k, key), values)
+        store.set_attrs(**{'%s_best' % name: {key: float(value) for key, value in best.items()},
+                           '%s_cost' % name: float(cost)})
+    store.set_attrs(constants=constants, dt=dt, mid_increase=mi, initial_theta=it, n=n, eta=eta, min_time=min_time,
+                    max_time=max_time, weights=weights)
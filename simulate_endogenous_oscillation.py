@@ -5,10 +5,10 @@ Created on Thu Dec 12 15:17:59 2024
 @author: pkeer
 """
 
-import pickle
-
 import controller as ctrl
 import simulation as sim
+from result_store import ResultStore
+from steady_state import SteadyStateCache
 from matplotlib import pyplot as plt
 import numpy as np
 import os
@@ -27,6 +27,7 @@ if __name__ == '__main__':
     dt = 0.01
 
     print('Simulations')
+    cache = SteadyStateCache('simulation_results/steady_state_cache')
     sigma = 0.19
     mi = (750, 15, 0)
     it = [20, 20, 0]
@@ -42,19 +43,23 @@ if __name__ == '__main__':
     
     
     history_no = sim.single_simulation(constants, simulation_time, dt, z_controller, init_state=it, mid_increase=mi,
-                                       steady_state_pad=steady_state_pad)
+                                       steady_state_pad=steady_state_pad, backend='compiled',
+                                       steady_state_cache=cache)
     
     history_adaptive = sim.single_simulation(constants, simulation_time, dt, control_mechanism=a_controller,
                                              control_start=200, init_state=it, mid_increase=mi,
-                                             steady_state_pad=steady_state_pad)
+                                             steady_state_pad=steady_state_pad, backend='compiled',
+                                             steady_state_cache=cache)
     
     history_proportional = sim.single_simulation(constants, simulation_time, dt, control_mechanism=p_controller,
                                                  control_start=200, init_state=it, mid_increase=mi,
-                                                 steady_state_pad=steady_state_pad)
+                                                 steady_state_pad=steady_state_pad, backend='compiled',
+                                                 steady_state_cache=cache)
     
     history_memoryless = sim.single_simulation(constants, simulation_time, dt, control_mechanism=m_controller,
                                              control_start=200, init_state=it, mid_increase=mi,
-                                             steady_state_pad=steady_state_pad)
+                                             steady_state_pad=steady_state_pad, backend='compiled',
+                                             steady_state_cache=cache)
     
    
     times = dt*np.arange(int(simulation_time/dt))
@@ -95,19 +100,10 @@ if __name__ == '__main__':
 
     print('Saving simulation results')
     file_dir = r"C:\Users\pkeer\OneDrive\Documents\GradSchool\Courses\Analysis of Nonlinear Dynamical Systems\FinalProject"
-    fullfile = os.path.join(file_dir, 'simulation_results/results_figure_3')
-    
-    with open(fullfile, 'wb+') as f:
-        pickle.dump({
-            'proportional': history_proportional[int(steady_state_pad / dt):],
-            'adaptive': history_adaptive[int(steady_state_pad / dt):],
-            'memoryless': history_memoryless[int(steady_state_pad / dt):],
-            'constants': constants,
-            'sigma': sigma,
-            'mid_increase': mi,
-            'initial_theta': it,
-            'simulation_time': simulation_time,
-            'dt': dt,
-            'tau_theta': tau_theta,
-            'prop_theta': prop_theta
-        }, f)
+    store = ResultStore(os.path.join(file_dir, 'simulation_results/figure_3'))
+    
+    store.put('proportional', history_proportional)
+    store.put('adaptive', history_adaptive)
+    store.put('memoryless', history_memoryless)
+    store.set_attrs(constants=constants, sigma=sigma, mid_increase=mi, initial_theta=it,
+                    simulation_time=simulation_time, dt=dt, tau_theta=tau_theta, prop_theta=prop_theta)
@@ -1,12 +1,9 @@
-import itertools
-import pickle
-from math import ceil, floor
-
 import numpy as np
-import scipy.signal as signal
 
-from controller import ZeroController
-from simulation import single_simulation, constants_nevado_holgado_healthy
+from result_store import ResultStore
+from simulation import constants_nevado_holgado_healthy
+from sweep import (AmplitudePoint, hysteresis, refined_grid, run_continuation, run_refinement, run_sweep, scattered,
+                   to_array, to_raster)
 
 if __name__ == '__main__':
     constants = constants_nevado_holgado_healthy
@@ -17,36 +14,52 @@ if __name__ == '__main__':
     simulation_time = 2000
     dt = 0.5
 
+    # continuation sweep: each point starts from the final state of its neighbour instead of
+    # init_state, forward and then backward over the grid, and may run for a shorter warm_time;
+    # points where the two passes settle on different attractors are stored as 'hysteresis'
+    continuation = False
+    warm_time = simulation_time
+
+    # adaptive refinement: starts on coarse_points per axis over the same ranges and splits cells whose
+    # STN amplitudes straddle threshold or differ by more than tol, down to 1 / 2 ** depth of the coarse
+    # spacing; stored as scattered points ('points', 'amplitude_points') and a raster on the finest grid
+    refine = False
+    coarse_points = 9
+    depth = 3
+    threshold = 1
+    tol = 20
+
     c12_range = np.arange(0, -4, -0.125)
     c21_range = np.arange(0, 32, 1)
 
-    stn_amplitude = np.zeros((len(c12_range), len(c21_range)))
-    gpe_amplitude = np.zeros((len(c12_range), len(c21_range)))
-
-    tail_len = int(ceil(800 / dt))
-    z = ZeroController()
-    for (i, c12), (j, c21) in itertools.product(enumerate(c12_range), enumerate(c21_range)):
-        print('Running simulations for c12=%.2f, c21=%.2f' % (c12, c21))
-        constants[3] = c12
-        constants[4] = c21
-        history = single_simulation(constants, simulation_time, dt, z)
-
-        div = 10
-        dhistory = signal.decimate(history, div, axis=0)
-        fs = 1000 / (dt * div)
-        nyq = fs / 2
-        b, a = signal.butter(5, [16 / nyq, 24 / nyq], btype='band')
-        sstn = signal.filtfilt(b, a, dhistory[:, 0])
-        sgpe = signal.filtfilt(b, a, dhistory[:, 1])
-
-        stn_amplitude[i, j] = np.ptp(sstn[-int(floor(tail_len / div)):])
-        gpe_amplitude[i, j] = np.ptp(sgpe[-int(floor(tail_len / div)):])
-
-        with open('simulation_results/results_figure_1a', 'wb+') as results_file:
-            pickle.dump({
-                'stn': stn_amplitude,
-                'gpe': gpe_amplitude,
-                'constants': constants,
-                'c12_range': c12_range,
-                'c21_range': c21_range
-            }, results_file)
+    store = ResultStore('simulation_results/figure_1a')
+    point = AmplitudePoint(constants, simulation_time, dt, tail_len=800, band=(16, 24), div=10)
+    grid = {3: c12_range, 4: c21_range}
+    if continuation:
+        forward, backward, spans = run_continuation(point, grid, warm_time)
+        amplitude = to_array(forward, grid)
+        amplitude_backward = to_array(backward, grid)
+        store.put('stn_backward', amplitude_backward[:, :, 0])
+        store.put('gpe_backward', amplitude_backward[:, :, 1])
+        store.put('hysteresis', to_array(hysteresis(spans), grid))
+    elif refine:
+        coarse = {k: np.linspace(v[0], v[-1], coarse_points) for k, v in grid.items()}
+        results = run_refinement(point, coarse, store, 'refinement', depth=depth, threshold=threshold, tol=tol,
+                                 chunksize=16, batched=True)
+        points, values = scattered(results, coarse, depth)
+        store.put('points', points)
+        store.put('amplitude_points', values)
+        grid = refined_grid(coarse, depth)
+        c12_range, c21_range = grid[3], grid[4]
+        amplitude = to_raster(points, values, grid)
+    else:
+        # each task integrates one row of the grid with batch_simulation; rerunning after an
+        # interruption only computes the rows missing from the store
+        results = run_sweep(point, grid, store, 'amplitude', chunksize=len(c21_range), batched=True)
+        amplitude = to_array(results, grid)
+
+    store.put('stn', amplitude[:, :, 0])
+    store.put('gpe', amplitude[:, :, 1])
+    store.put('c12_range', c12_range)
+    store.put('c21_range', c21_range)
+    store.set_attrs(constants=constants)
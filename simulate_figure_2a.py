@@ -1,10 +1,12 @@
-import pickle
-from math import ceil
+from functools import partial
 
 import numpy as np
 
-from controller import ZeroController, AdaptiveControllerFilter
-from simulation import single_simulation, constants_nevado_holgado_healthy
+from controller import AdaptiveControllerFilter, StreamingAdaptiveControllerFilter
+from frequency_response import frequency_response
+from result_store import ResultStore
+from simulation import constants_nevado_holgado_healthy
+from sweep import AmplitudePoint, run_sweep, to_array
 
 if __name__ == "__main__":
     constants = constants_nevado_holgado_healthy
@@ -15,33 +17,47 @@ if __name__ == "__main__":
     dt = 0.05
 
     plot_color = False
+    # True for the causal O(1)-per-step filter instead of the zero-phase filtfilt estimator of the
+    # paper; it changes the controlled amplitudes by up to ~13%
+    streaming_filter = False
+    # uncontrolled response from one run per cortical level with a sweeping drive ('chirp' or
+    # 'stepped', see frequency_response.py) instead of one run per frequency; None for the latter
+    sweep_mode = None
     print('Simulations')
 
     f_range = np.arange(3, 101, 0.5)
     ctx_range = np.array([10, 22])
     stn_amplitude = np.zeros((len(f_range), len(ctx_range), 4))
     gpe_amplitude = np.zeros((len(f_range), len(ctx_range), 4))
-
-    for ci, cv in enumerate(ctx_range):
-        constants[18] = cv
-        for i, f in enumerate(f_range):
-            print('Running simulation for cortical mean value %.1f and frequency %.1f Hz' % (cv, f))
-            constants[17] = f
-            z = ZeroController()
-            a = AdaptiveControllerFilter(0.1, 50, dt)
-
-            history_zero = single_simulation(constants, simulation_time, dt, control_mechanism=z, control_start=200)
-            history_adaptive = single_simulation(constants, simulation_time, dt, control_mechanism=a, control_start=200,
-                                                 init_state=[20, 20, 0])
-            tail_length = int(ceil(800 / dt))
-            stn_amplitude[i, ci, 1] = np.ptp(history_zero[-tail_length:, 0])
-            stn_amplitude[i, ci, 2] = np.ptp(history_adaptive[-tail_length:, 0])
-            gpe_amplitude[i, ci, 1] = np.ptp(history_zero[-tail_length:, 1])
-            gpe_amplitude[i, ci, 2] = np.ptp(history_adaptive[-tail_length:, 1])
-    with open('simulation_results/results_figure_2a', 'wb+') as results_file:
-        pickle.dump({
-            'stn': stn_amplitude,
-            'gpe': gpe_amplitude,
-            'constants': constants,
-            'f_range': f_range
-        }, results_file)
+    grid = {17: f_range, 18: ctx_range}
+    store = ResultStore('simulation_results/figure_2a')
+
+    print('Running simulations without control')
+    if sweep_mode is not None:
+        amplitude = np.zeros((len(f_range), len(ctx_range), 2))
+        for k, ctx in enumerate(ctx_range):
+            c = list(constants)
+            c[18] = ctx
+            amplitude[:, k] = frequency_response(c, f_range, dt, mode=sweep_mode)
+    else:
+        point = AmplitudePoint(constants, simulation_time, dt, band=None, control_start=200)
+        amplitude = to_array(run_sweep(point, grid, store, 'zero', chunksize=8, batched=True), grid)
+    stn_amplitude[:, :, 1] = amplitude[:, :, 0]
+    gpe_amplitude[:, :, 1] = amplitude[:, :, 1]
+
+    print('Running simulations with self-tuning control')
+    if streaming_filter:
+        controller = partial(StreamingAdaptiveControllerFilter, 0.1, 50, dt)
+    else:
+        controller = partial(AdaptiveControllerFilter, 0.1, 50, dt)
+    point = AmplitudePoint(constants, simulation_time, dt, controller=controller, band=None, control_start=200,
+                           init_state=[20, 20, 0])
+    name = 'adaptive_streaming' if streaming_filter else 'adaptive'
+    amplitude = to_array(run_sweep(point, grid, store, name), grid)
+    stn_amplitude[:, :, 2] = amplitude[:, :, 0]
+    gpe_amplitude[:, :, 2] = amplitude[:, :, 1]
+
+    store.put('stn', stn_amplitude)
+    store.put('gpe', gpe_amplitude)
+    store.put('f_range', f_range)
+    store.set_attrs(constants=constants)
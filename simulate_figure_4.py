@@ -1,7 +1,7 @@
-import pickle
-
 import controller as ctrl
 import simulation as sim
+from result_store import ResultStore
+from steady_state import SteadyStateCache
 
 if __name__ == '__main__':
     steady_state_pad = 1000
@@ -16,6 +16,7 @@ if __name__ == '__main__':
     dt = 0.01
 
     print('Simulations')
+    cache = SteadyStateCache('simulation_results/steady_state_cache')
     sigma = 0.01
     mi = (750, 10, 50)
     it = [20, 20, 0]
@@ -26,22 +27,16 @@ if __name__ == '__main__':
     a_controller = ctrl.AdaptiveController(sigma=sigma, tau_theta=tau_theta, dt=dt)
     history_adaptive = sim.single_simulation(constants, simulation_time, dt, control_mechanism=a_controller,
                                              control_start=200, init_state=it, mid_increase=mi,
-                                             steady_state_pad=steady_state_pad)
+                                             steady_state_pad=steady_state_pad, backend='compiled',
+                                             steady_state_cache=cache)
     history_proportional = sim.single_simulation(constants, simulation_time, dt, control_mechanism=p_controller,
                                                  control_start=200, init_state=prop_theta, mid_increase=mi,
-                                                 steady_state_pad=steady_state_pad)
+                                                 steady_state_pad=steady_state_pad, backend='compiled',
+                                                 steady_state_cache=cache)
 
     print('Saving simulation results')
-    with open('simulation_results/results_figure_4', 'wb+') as f:
-        pickle.dump({
-            'proportional': history_proportional[int(steady_state_pad / dt):],
-            'adaptive': history_adaptive[int(steady_state_pad / dt):],
-            'constants': constants,
-            'sigma': sigma,
-            'mid_increase': mi,
-            'initial_theta': it,
-            'simulation_time': simulation_time,
-            'dt': dt,
-            'tau_theta': tau_theta,
-            'prop_theta': prop_theta
-        }, f)
+    store = ResultStore('simulation_results/figure_4')
+    store.put('proportional', history_proportional)
+    store.put('adaptive', history_adaptive)
+    store.set_attrs(constants=constants, sigma=sigma, mid_increase=mi, initial_theta=it,
+                    simulation_time=simulation_time, dt=dt, tau_theta=tau_theta, prop_theta=prop_theta)
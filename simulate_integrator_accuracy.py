@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+
+import controller as ctrl
+import simulation as sim
+
+if __name__ == '__main__':
+    # Figure 4 model without control
+    constants = list(sim.constants_nevado_holgado_healthy)
+    constants[5] = -0.9
+    constants[16] = 10
+    constants[17] = 20
+    constants[18] = 50
+
+    # Figure 3 model with the adaptive controller
+    constants_controlled = list(sim.constants_nevado_holgado_healthy)
+    constants_controlled[3] = -3
+    constants_controlled[4] = 10
+    constants_controlled[5] = -0.9
+    constants_controlled[14] = 5
+    constants_controlled[15] = -139.4
+
+    simulation_time = 1000
+    it = [20, 20, 0]
+    reference_dt = 0.005
+
+    def stn_on_1ms_grid(history, model, dt):
+        # STN at t = 0, 1, ..., simulation_time - 1 ms
+        start, delta, n_steps = sim._time_grid(max(model[6:10]), simulation_time, dt)
+        rows = np.round((np.arange(simulation_time) - start) / delta).astype(int)
+        return history[rows, 0]
+
+    for title, model, controller, mi, runs in [
+        ('Figure 4 model, no control', constants, lambda dt: ctrl.ZeroController(), (750, 10, 50),
+         [('euler', [0.01, 0.05, 0.1, 0.5]), ('heun', [0.05, 0.1, 0.5, 1]), ('rk4', [0.05, 0.1, 0.5, 1]),
+          ('rk23', [0.5, 1])]),
+        ('Figure 3 model, AdaptiveController', constants_controlled,
+         lambda dt: ctrl.AdaptiveController(sigma=0.19, tau_theta=75, dt=dt), (750, 15, 0),
+         [('euler', [0.05, 0.1, 0.5]), ('heun', [0.05, 0.1, 0.5]), ('rk4', [0.05, 0.1, 0.5])]),
+    ]:
+        reference = sim.simulate(model, simulation_time, reference_dt, controller(reference_dt), init_state=it,
+                                 mid_increase=mi, method='rk4')
+        ref = stn_on_1ms_grid(reference, model, reference_dt)
+        print(title)
+        print('method  dt     steps   max error  time [s]')
+        for method, dts in runs:
+            for dt in dts:
+                t0 = time.time()
+                history, info = sim.simulate(model, simulation_time, dt, controller(dt), init_state=it,
+                                             mid_increase=mi, method=method, full_output=True)
+                elapsed = time.time() - t0
+                err = np.max(np.abs(stn_on_1ms_grid(history, model, dt) - ref))
+                print('%-7s %-6g %-7d %-10.2e %.2f' % (method, dt, info['steps'], err, elapsed))
@@ -5,10 +5,10 @@ Created on Thu Dec 12 14:49:01 2024
 @author: pkeer
 """
 
-import pickle
-
 import controller as ctrl
 import simulation as sim
+from result_store import ResultStore
+from steady_state import SteadyStateCache
 import os
 from matplotlib import pyplot as plt
 import numpy as np
@@ -26,6 +26,7 @@ if __name__ == '__main__':
     dt = 0.01
 
     print('Simulations')
+    cache = SteadyStateCache('simulation_results/steady_state_cache')
     sigma = 0.01
     change_time = 1500
     control_start_time = 200
@@ -42,20 +43,24 @@ if __name__ == '__main__':
     
     
     
-    history_no = sim.single_simulation_striatal(constants, simulation_time, dt, z_controller, init_state=it, mid_increase=mi,
-                                       steady_state_pad=steady_state_pad)
+    history_no = sim.simulate(constants, simulation_time, dt, z_controller, init_state=it, mid_increase=mi,
+                                       steady_state_pad=steady_state_pad, route='str', backend='compiled',
+                                       steady_state_cache=cache)
     
-    history_adaptive = sim.single_simulation_striatal(constants, simulation_time, dt, control_mechanism=a_controller,
+    history_adaptive = sim.simulate(constants, simulation_time, dt, control_mechanism=a_controller,
                                              control_start=control_start_time, init_state=it, mid_increase=mi,
-                                             steady_state_pad=steady_state_pad)
+                                             steady_state_pad=steady_state_pad, route='str', backend='compiled',
+                                             steady_state_cache=cache)
     
-    history_proportional = sim.single_simulation_striatal(constants, simulation_time, dt, control_mechanism=p_controller,
+    history_proportional = sim.simulate(constants, simulation_time, dt, control_mechanism=p_controller,
                                                  control_start=control_start_time, init_state=it, mid_increase=mi,
-                                                 steady_state_pad=steady_state_pad)
+                                                 steady_state_pad=steady_state_pad, route='str', backend='compiled',
+                                                 steady_state_cache=cache)
     
-    history_memoryless = sim.single_simulation_striatal(constants, simulation_time, dt, control_mechanism=m_controller,
+    history_memoryless = sim.simulate(constants, simulation_time, dt, control_mechanism=m_controller,
                                              control_start=control_start_time, init_state=it, mid_increase=mi,
-                                             steady_state_pad=steady_state_pad)
+                                             steady_state_pad=steady_state_pad, route='str', backend='compiled',
+                                             steady_state_cache=cache)
     
    
     times = dt*np.arange(int(simulation_time/dt))
@@ -96,19 +101,10 @@ if __name__ == '__main__':
 
     print('Saving simulation results')
     file_dir = r"C:\Users\pkeer\OneDrive\Documents\GradSchool\Courses\Analysis of Nonlinear Dynamical Systems\FinalProject"
-    fullfile = os.path.join(file_dir, 'simulation_results/results_figure_4')
+    store = ResultStore(os.path.join(file_dir, 'simulation_results/figure_4'))
 
     print('Saving simulation results')
-    with open(fullfile, 'wb+') as f:
-        pickle.dump({
-            'proportional': history_proportional[int(steady_state_pad / dt):],
-            'adaptive': history_adaptive[int(steady_state_pad / dt):],
-            'constants': constants,
-            'sigma': sigma,
-            'mid_increase': mi,
-            'initial_theta': it,
-            'simulation_time': simulation_time,
-            'dt': dt,
-            'tau_theta': tau_theta,
-            'prop_theta': prop_theta
-        }, f)
+    store.put('proportional', history_proportional)
+    store.put('adaptive', history_adaptive)
+    store.set_attrs(constants=constants, sigma=sigma, mid_increase=mi, initial_theta=it,
+                    simulation_time=simulation_time, dt=dt, tau_theta=tau_theta, prop_theta=prop_theta)
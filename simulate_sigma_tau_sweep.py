@@ -0,0 +1,40 @@
+import numpy as np
+
+import controller as ctrl
+import simulation as sim
+from result_store import ResultStore
+from sweep import tail_amplitude
+
+if __name__ == '__main__':
+    # Figure 3 model under self-tuning control, swept over sigma and tau_theta in one batch: every
+    # (sigma, tau_theta) pair is one row of an AdaptiveControllerBank
+    constants = sim.constants_nevado_holgado_healthy
+    constants[3] = -3
+    constants[4] = 10
+    constants[5] = -0.9
+    constants[14] = 5
+    constants[15] = -139.4
+
+    simulation_time = 3000
+    dt = 0.05
+    mi = (750, 15, 0)
+    it = [20, 20, 0]
+
+    sigma_range = np.linspace(0.05, 0.5, 20)
+    tau_theta_range = np.linspace(25, 200, 15)
+    sigma, tau_theta = (g.ravel() for g in np.meshgrid(sigma_range, tau_theta_range, indexing='ij'))
+
+    bank = ctrl.AdaptiveControllerBank(sigma, tau_theta, dt)
+    history = sim.batch_simulation([constants] * len(sigma), simulation_time, dt, bank, control_start=200,
+                                   init_state=it, mid_increase=mi)
+
+    # beta-band amplitude of STN and GPe over the last second, and the final gain
+    amplitude = tail_amplitude(history, dt, tail_len=1000, band=(15, 30))
+    shape = (len(sigma_range), len(tau_theta_range))
+    store = ResultStore('simulation_results/sigma_tau_sweep')
+    store.put('stn', amplitude[:, 0].reshape(shape))
+    store.put('gpe', amplitude[:, 1].reshape(shape))
+    store.put('theta', history[:, -1, 2].reshape(shape))
+    store.put('sigma_range', sigma_range)
+    store.put('tau_theta_range', tau_theta_range)
+    store.set_attrs(constants=constants, simulation_time=simulation_time, dt=dt, mid_increase=mi, initial_theta=it)
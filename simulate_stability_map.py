@@ -0,0 +1,27 @@
+import numpy as np
+
+from result_store import ResultStore
+from simulation import constants_nevado_holgado_healthy
+from stability import stability_boundary, stability_map
+
+if __name__ == '__main__':
+    # linear screening of the Figure 1a grid: no simulations, a few seconds for the whole grid
+    constants = constants_nevado_holgado_healthy
+    constants[5] = -4
+    constants[14] = 8
+    constants[15] = -139.4
+
+    c12_range = np.arange(0, -4, -0.125)
+    c21_range = np.arange(0, 32, 1)
+
+    # growth rate [1/ms] and frequency [Hz] of the rightmost characteristic root; growth > 0 predicts
+    # oscillations, at the frequency they start with (they settle at lower ones far from the boundary)
+    growth, frequency = stability_map(constants, c12_range, c21_range)
+
+    store = ResultStore('simulation_results/stability_map')
+    store.put('growth', growth)
+    store.put('frequency', frequency)
+    store.put('boundary', stability_boundary(c12_range, c21_range, growth))
+    store.put('c12_range', c12_range)
+    store.put('c21_range', c21_range)
+    store.set_attrs(constants=constants)
@@ -1,8 +1,13 @@
-from math import floor
+import copy
+from bisect import bisect_left
+from functools import lru_cache
+from math import ceil, floor
 
 import numpy as np
 import scipy.signal as signal
 
+import kernels
+
 constants_nevado_holgado_healthy = [
     6,  # 0:  tau1 [ms]
     14,  # 1:  tau2 [ms]
@@ -35,6 +40,11 @@ def butter_bandpass(lowcut, highcut, fs, order=5):
     return b, a
 
 
+def butter_bandpass_sos(lowcut, highcut, fs, order=5):
+    nyq = 0.5 * fs
+    return signal.butter(order, [lowcut / nyq, highcut / nyq], btype='band', output='sos')
+
+
 def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
     b, a = butter_bandpass(lowcut, highcut, fs, order=order)
     y = signal.filtfilt(b, a, data)
@@ -55,121 +65,717 @@ def activation2(x, constants):
     return sigmoid(x, constants[12], constants[13])
 
 
-def single_simulation(constants, simulation_time, dt, control_mechanism, control_start=200, init_state=[20, 20, 40],
-                      mid_increase=(750, 0, 0), steady_state_pad=0):
-    max_delay = max(constants[6:10])
-    tt = np.arange(-max_delay, simulation_time + steady_state_pad, dt)
-    history = np.zeros((len(tt), 3))
-    control_history = np.zeros((len(tt),))
-    input_history = np.zeros((len(tt),))
-
-    mi_t = mid_increase[0]
-    mi_mean = mid_increase[1]
-    mi_amplitude = mid_increase[2]
+ROUTES = ('ctx', 'str', 'both')
+
+# steps whose drive waveforms are computed at once; bounds the memory of long runs
+_BLOCK = 65536
+_RECORD_BLOCK = 4096
+
+
+def _time_grid(max_delay, stop, dt):
+    # same points as np.arange(-max_delay, stop, dt): t_i = start + i * delta
+    start = -max_delay
+    delta = (start + dt) - start
+    return start, delta, int(ceil((stop - start) / dt))
+
+
+def _waveform(w, t, i0):
+    # a drive given as a function of t [ms], or as an array over the run's steps
+    # (held over each step when t has extra axes, e.g. Runge-Kutta stage times)
+    if callable(w):
+        return w(t)
+    return np.asarray(w)[i0:i0 + len(t)].reshape((-1,) + (1,) * (np.ndim(t) - 1))
+
+
+def drive_waveforms(constants, t, mid_increase=(750, 0, 0), steady_state_pad=0, route='ctx', drives=None, i0=0):
+    # Cortical and striatal input at times t (vectorized). The oscillation given by constants[16:18]
+    # and the mid-run increase go to the channels selected by route; drives = {'ctx': w, 'str': w}
+    # adds arbitrary waveforms on top. Also returns the routed oscillation.
+    if route not in ROUTES:
+        raise ValueError('Unknown input route: %s' % route)
+    mi_t, mi_mean, mi_amplitude = mid_increase
+    after = t > mi_t + steady_state_pad
+
+    amplitude = constants[16]
+    if mi_amplitude > 0:
+        amplitude = amplitude + np.where(after, mi_amplitude, 0)
+    oscillation = amplitude * np.sin(2 * np.pi * constants[17] * t / 1000)
+
+    inputs = {}
+    for channel, level in [('ctx', constants[18]), ('str', constants[19])]:
+        x = np.zeros(np.broadcast(t, oscillation).shape) + level
+        if route in (channel, 'both'):
+            x = level + oscillation
+            if mi_mean > 0:
+                x = x + np.where(after, mi_mean, 0)
+        if drives is not None and channel in drives:
+            x = x + _waveform(drives[channel], t, i0)
+        inputs[channel] = x
+    return inputs['ctx'], inputs['str'], oscillation
+
+
+def _delay_line_length(n_steps, hlen, control_mechanism, keep_history):
+    # rows kept by the engine: the whole run, or a ring buffer covering the longest delay and,
+    # for controllers without step(), the history window they read
+    if keep_history:
+        return n_steps
+    length = hlen + 2
+    if getattr(control_mechanism, 'step', None) is None:
+        window = getattr(control_mechanism, 'window', None)
+        if window is None:
+            raise ValueError('Controller needs the full history; use keep_history=True or give it a step() method')
+        length = max(length, window + 1)
+    return min(length, n_steps)
+
+
+def _window(history, i, n):
+    # the last n rows written before run row i, oldest first
+    length = len(history)
+    n = min(n, i)
+    start = (i - n) % length
+    if start + n <= length:
+        return history[start:start + n]
+    return np.concatenate((history[start:], history[:start + n - length]))
+
+
+def _unroll(history, n_steps):
+    # orders a (possibly wrapped) delay line oldest row first
+    return _window(history, n_steps, len(history))
+
+
+class _Recorder:
+    # Rows simulate returns with the record_* options: every `every`-th row from row `first` on, copied
+    # out block by block, with the control and external inputs of those rows if traces
+    def __init__(self, n_steps, first, every, dtype, traces):
+        self.rows = np.arange(first, n_steps, every)
+        self.history = np.zeros((len(self.rows), 3), dtype=dtype)
+        self.control = np.full(len(self.rows), np.nan) if traces else None
+        self.inputs = np.full((len(self.rows), 2), np.nan) if traces else None
+
+    def block(self, rows, i0, control=None, ext1=None, ext2=None):
+        # rows: run rows i0 .. i0 + len(rows) - 1; control, ext1, ext2 for the same rows
+        a, b = np.searchsorted(self.rows, (i0, i0 + len(rows)))
+        k = self.rows[a:b] - i0
+        self.history[a:b] = rows[k]
+        if self.control is not None and control is not None:
+            self.control[a:b] = control[k]
+            self.inputs[a:b, 0] = ext1[k]
+            self.inputs[a:b, 1] = ext2[k]
+
+
+METHODS = ('euler', 'heun', 'rk4', 'rk23')
+
+# Butcher tableaus (c, a, b); for rk23 (Bogacki-Shampine) b is the 3rd order solution and
+# _RK23_ERROR the difference to the embedded 2nd order one
+_TABLEAUS = {
+    'heun': ((0, 1), ((), (1,)), (1 / 2, 1 / 2)),
+    'rk4': ((0, 1 / 2, 1 / 2, 1), ((), (1 / 2,), (0, 1 / 2), (0, 0, 1)), (1 / 6, 1 / 3, 1 / 3, 1 / 6)),
+    'rk23': ((0, 1 / 2, 3 / 4, 1), ((), (1 / 2,), (0, 3 / 4), (2 / 9, 1 / 3, 4 / 9)), (2 / 9, 1 / 3, 4 / 9, 0)),
+}
+_RK23_ERROR = (2 / 9 - 7 / 24, 1 / 3 - 1 / 4, 4 / 9 - 1 / 3, -1 / 8)
+
+# Accuracy against steps: max |STN error| on a 1 ms grid over 1000 ms, reference rk4 at dt=0.005,
+# from simulate_integrator_accuracy.py. Without control (Figure 4 model, 20 Hz cortical drive,
+# increase at 750 ms) Euler converges at first order and its delays are rounded to whole steps; heun
+# is second order, rk4 third to fourth (the kinks the input jump leaves in the delayed states limit
+# it); rk23 meets rtol=atol=1e-6 per substep. Controlled runs (Figure 3 model, AdaptiveController,
+# increase at 750 ms) are first order with every method: the control input is held over each step
+# and theta and w are stepped with Euler. The higher-order methods still gain about a factor of 9
+# over Euler there, from the interpolated delays.
+#
+#   no control
+#   method  dt     steps   max error
+#   euler   0.01   99999   1.51e-01
+#   euler   0.05   19999   7.58e-01
+#   euler   0.1    9999    1.52e+00
+#   euler   0.5    1999    7.74e+00
+#   heun    0.05   19999   2.76e-03
+#   heun    0.1    9999    1.11e-02
+#   heun    0.5    1999    2.84e-01
+#   heun    1      999     1.17e+00
+#   rk4     0.05   19999   6.83e-07
+#   rk4     0.1    9999    5.48e-06
+#   rk4     0.5    1999    6.95e-04
+#   rk4     1      999     8.43e-03
+#   rk23    0.5    4720    1.14e-03
+#   rk23    1      4277    7.85e-03
+#
+#   AdaptiveController
+#   method  dt     steps   max error
+#   euler   0.05   19999   3.60e-01
+#   euler   0.1    9999    7.27e-01
+#   euler   0.5    1999    3.86e+00
+#   heun    0.05   19999   3.94e-02
+#   heun    0.1    9999    8.35e-02
+#   heun    0.5    1999    4.52e-01
+#   rk4     0.05   19999   3.94e-02
+#   rk4     0.1    9999    8.34e-02
+#   rk4     0.5    1999    4.50e-01
+
+
+@lru_cache(maxsize=1024)
+def _lagrange(o, lo=None, hi=None):
+    # row offsets (relative to the last stored row, never after it) and cubic Lagrange weights for the
+    # value at fractional row offset o, using only rows lo .. hi when given; whole rows are read directly
+    base = floor(o)
+    if o == base and base <= 0:
+        return (base,), (1.,)
+    last = min(base + 2, 0) if hi is None else hi
+    first = last - 3 if lo is None else min(max(last - 3, lo), last)
+    nodes = range(first, last + 1)
+    weights = []
+    for k in nodes:
+        w = 1.
+        for m in nodes:
+            if m != k:
+                w *= (o - m) / (k - m)
+        weights.append(w)
+    return tuple(nodes), tuple(weights)
+
+
+class _RungeKutta:
+    # Advances STN and GPe over one output interval with an explicit Runge-Kutta method. Delayed states
+    # at stage times are interpolated from the stored rows; control is held over the interval. rk23
+    # subdivides the interval into error-controlled substeps.
+    def __init__(self, method, constants, dt, rtol, atol, init_state, breaks):
+        self.c, self.a, self.b = _TABLEAUS[method]
+        # drives are sampled just inside each step, so a jump on a grid point is seen from the right side
+        self.c_drive = tuple(np.clip(self.c, 1e-9, 1 - 1e-9))
+        # (fractional) rows where the solution has a kink: the end of the constant initial history,
+        # then jumps of the input. Interpolation stencils never straddle one, which would cost the
+        # methods their order. With init_state None the run starts from given rows (init_history),
+        # the first break is row 0 and delayed values before it are read from that row.
+        self.init_state = None if init_state is None else np.broadcast_to(init_state, (3,))
+        self.breaks = sorted(breaks)
+        self.adaptive = method == 'rk23'
+        self.dt = dt
+        self.rtol = rtol
+        self.atol = atol
+        self.h = 1.
+        self.steps = 0
+        self.rejected = 0
+        self.r0 = 1 / constants[0]
+        self.r1 = 1 / constants[1]
+        self.c2, self.c3, self.c4, self.c5 = constants[2:6]
+        self.m1, self.b1, self.m2, self.b2 = constants[10:14]
+        # delay in rows for c11, c12, c21, c22
+        self.delays = [constants[k] / dt for k in range(6, 10)]
+
+    def _delayed(self, history, n, i, o, col):
+        q = i - 1 + o
+        b = bisect_left(self.breaks, q)
+        if b == 0:
+            return history[0, col] if self.init_state is None else self.init_state[col]
+        last = min(floor(o) + 2, 0)
+        lo = ceil(self.breaks[b - 1]) - (i - 1)
+        hi = floor(self.breaks[b]) - (i - 1) if b < len(self.breaks) else 0
+        nodes, weights = _lagrange(o, lo if lo > last - 3 else None, hi if hi < last else None)
+        value = 0.
+        for k, w in zip(nodes, weights):
+            value += w * history[max(i - 1 + k, 0) % n, col]
+        return value
+
+    def rhs(self, history, n, i, o, y0, y1, u, e1, e2):
+        # derivative at row offset o after row i - 1
+        d11, d12, d21, d22 = self.delays
+        x11 = y0 if d11 == 0 else self._delayed(history, n, i, o - d11, 0)
+        x12 = y1 if d12 == 0 else self._delayed(history, n, i, o - d12, 1)
+        x21 = y0 if d21 == 0 else self._delayed(history, n, i, o - d21, 0)
+        x22 = y1 if d22 == 0 else self._delayed(history, n, i, o - d22, 1)
+        inputs1 = self.c2 * x11 + self.c3 * x12 + e1
+        inputs2 = self.c4 * x21 + self.c5 * x22 + e2
+        return (self.r0 * (-y0 + sigmoid(inputs1 + u, self.m1, self.b1)),
+                self.r1 * (-y1 + sigmoid(inputs2, self.m2, self.b2)))
+
+    def _stages(self, history, n, i, tau, h, y0, y1, u, e1, e2):
+        k = []
+        for s, (cs, a_s) in enumerate(zip(self.c, self.a)):
+            z0 = y0 + h * self.dt * sum(a * kk[0] for a, kk in zip(a_s, k))
+            z1 = y1 + h * self.dt * sum(a * kk[1] for a, kk in zip(a_s, k))
+            k.append(self.rhs(history, n, i, tau + cs * h, z0, z1, u, e1[s], e2[s]))
+        return k
+
+    def step(self, history, n, i, y0, y1, u, e1, e2):
+        # e1, e2: external inputs at the stage times
+        k = self._stages(history, n, i, 0, 1, y0, y1, u, e1, e2)
+        self.steps += 1
+        return (y0 + self.dt * sum(b * kk[0] for b, kk in zip(self.b, k)),
+                y1 + self.dt * sum(b * kk[1] for b, kk in zip(self.b, k)))
+
+    def adaptive_step(self, history, n, i, y0, y1, u, inputs):
+        # inputs(offsets) gives the external inputs at row offsets after row i - 1
+        tau = 0.
+        while tau < 1:
+            h = min(self.h, 1 - tau)
+            e1, e2 = inputs([tau + cs * h for cs in self.c_drive])
+            k = self._stages(history, n, i, tau, h, y0, y1, u, e1, e2)
+            z0 = y0 + h * self.dt * sum(b * kk[0] for b, kk in zip(self.b, k))
+            z1 = y1 + h * self.dt * sum(b * kk[1] for b, kk in zip(self.b, k))
+            err0 = h * self.dt * sum(e * kk[0] for e, kk in zip(_RK23_ERROR, k))
+            err1 = h * self.dt * sum(e * kk[1] for e, kk in zip(_RK23_ERROR, k))
+            err = max(abs(err0) / (self.atol + self.rtol * max(abs(y0), abs(z0))),
+                      abs(err1) / (self.atol + self.rtol * max(abs(y1), abs(z1))))
+            factor = 5. if err == 0 else min(5., max(0.2, 0.9 * err ** (-1 / 3)))
+            if err <= 1:
+                tau += h
+                y0, y1 = z0, z1
+                self.steps += 1
+                # a substep cut short by the end of the interval says little about the step size
+                if h == self.h:
+                    self.h = min(1., h * factor)
+            else:
+                self.rejected += 1
+                self.h = h * factor
+        return y0, y1
+
+
+def _detectors(stop_when):
+    if stop_when is None:
+        return []
+    return list(stop_when) if isinstance(stop_when, (list, tuple)) else [stop_when]
+
+
+def _detector_rows(detector, dt):
+    return int(ceil(detector.window / dt)) + 1
+
+
+def _last_event(mid_increase, steady_state_pad, control_from, drives):
+    # time of the last scheduled input change (controller switched on, mid-run increase); an
+    # extrapolated run must not skip one. Drives are arbitrary waveforms, so they rule stopping out.
+    if drives is not None:
+        raise ValueError('stop_when cannot be used with drives')
+    last = control_from
+    if mid_increase[1] > 0 or mid_increase[2] > 0:
+        last = max(last, mid_increase[0] + steady_state_pad)
+    return last
+
+
+def _converged(detectors, history, i, t, dt, first_row, batch_rows=None, after=-np.inf):
+    # which detectors fire on the rows before run row i (t: time of the last of them); they see at
+    # most their window and only rows after the constant initial history and after the time `after`
+    # (the last input change). Shape (detectors,) + batch shape, or (detectors, len(batch_rows)) for a
+    # subset of a batch.
+    fired = []
+    for detector in detectors:
+        rows = min(_detector_rows(detector, dt), i - first_row - 1)
+        shape = history.shape[1:-1] if batch_rows is None else (len(batch_rows),)
+        if t < detector.min_time or t < after + detector.window or rows < 2:
+            fired.append(np.zeros(shape, dtype=bool))
+            continue
+        window = _window(history, i, rows)
+        if batch_rows is not None:
+            window = window[:, batch_rows]
+        fired.append(np.asarray(detector(window, dt), dtype=bool))
+    return np.array(fired)
+
+
+def _kernel_spec(control_mechanism):
+    kernel_spec = getattr(control_mechanism, 'kernel_spec', None)
+    return kernel_spec() if kernel_spec is not None else None
+
+
+def simulate(constants, simulation_time, dt, control_mechanism, control_start=200, init_state=[20, 20, 40],
+             mid_increase=(750, 0, 0), steady_state_pad=0, route='ctx', drives=None, backend='python',
+             keep_history=True, method='euler', rtol=1e-6, atol=1e-6, full_output=False, init_history=None,
+             steady_state_cache=None, stop_when=None, check_every=50, profile=None, record_every=1,
+             record_tail=None, record_dtype=None, record_traces=False, realtime=None):
+    # Integration of the delayed STN/GPe rate model with the theta of the controller as third state
+    # variable. route selects where the oscillating input and mid_increase enter ('ctx', 'str' or
+    # 'both'); drives adds per-channel waveforms (see drive_waveforms). backend='compiled' runs the
+    # built-in controllers in kernels.euler_kernel and falls back to Python for anything else.
+    # keep_history=False runs on a ring buffer and returns only its final contents.
+    # method is 'euler' (the original scheme, delays rounded down to whole steps), 'heun', 'rk4' or
+    # 'rk23' (error-controlled substeps within each dt, see rtol/atol); the higher-order methods
+    # interpolate delayed states and sample the controller once per dt, holding its output and
+    # stepping theta with Euler, so controlled runs stay first order in dt (see the accuracy table
+    # above). full_output=True also returns a dict with the number of integration steps.
+    # init_history gives the first rows of the run (at least the constant history before t = 0, which
+    # init_state fills otherwise); they are not integrated, but the controller is still called on them.
+    # With a steady_state.SteadyStateCache as steady_state_cache, the returned history leaves out the
+    # uncontrolled steady_state_pad except its last hlen rows (history[int(steady_state_pad / dt):] of
+    # a run without the cache). For the built-in controllers (those with a kernel_spec) the delay line
+    # and the controller state w at the end of the pad are read from (or computed once into) the
+    # cache and the integration starts there; other runs (drives, init_history, record_* options,
+    # higher-order methods) integrate the pad as usual.
+    # stop_when takes convergence detectors (see convergence.py), checked every check_every ms; the
+    # integration ends at the first one that fires and the detector extrapolates the rest of the run.
+    # Detectors only look at rows after the last input change (control_start, mid_increase), and
+    # stop_when cannot be combined with drives. info gives the reason ('fixed point', 'limit cycle' or
+    # None) and the time integration stopped.
+    # profile takes a profiling.Profiler, which times the phases of the run and the controller calls
+    # separately; its summary is info['profile'].
+    # The record_* options cut down what is kept: every record_every-th row of the last record_tail ms,
+    # stored as record_dtype (e.g. np.float32). record_traces=True adds the control input and the
+    # external (cctx * ctx, cstr * str) inputs of those rows as info['control'] and info['inputs'],
+    # nan after an early stop; info['time'] gives the times of the rows. Recorded runs integrate on a
+    # ring buffer whenever the controller allows it, so memory scales with the recorded rows.
+    # realtime takes a realtime.Pacer, which paces the controller calls to the wall clock (Python
+    # backend only) and records their latency and deadline misses; its summary is info['realtime'].
+    if realtime is not None:
+        realtime.start(dt)
+        realtime.controller = type(control_mechanism).__name__
+    if profile is not None:
+        profile.start('setup')
+        profile.controller = type(control_mechanism).__name__
+    if backend not in ('python', 'compiled'):
+        raise ValueError('Unknown backend: %s' % backend)
+    if method not in METHODS:
+        raise ValueError('Unknown method: %s' % method)
+    recording = record_every != 1 or record_tail is not None or record_dtype is not None or record_traces
+    # rows of the time grid skipped, and the time up to which rows are given rather than integrated
+    offset = 0
+    t_first = 0
+    if steady_state_cache is not None and steady_state_pad > 0 and init_history is None and drives is None \
+            and mid_increase[0] >= 0 and method == 'euler' and not recording \
+            and _kernel_spec(control_mechanism) is not None:
+        init_history, control_mechanism.w = _pad_state(steady_state_cache, constants, dt, control_mechanism,
+                                                       control_start, init_state, steady_state_pad, route, backend)
+    spec = _kernel_spec(control_mechanism) if backend == 'compiled' and method == 'euler' and realtime is None \
+        else None
 
+    max_delay = max(constants[6:10])
+    start, delta, n_steps = _time_grid(max_delay, simulation_time + steady_state_pad, dt)
     hlen = int(floor(max_delay / dt))
+    trim = 0
+    if steady_state_cache is not None and steady_state_pad > 0:
+        # rows before the last hlen of the pad are left out of the result
+        trim = _time_grid(max_delay, steady_state_pad, dt)[2] - hlen
+        if init_history is not None and len(init_history) == hlen + 1:
+            # the run starts from the cached delay line, which ends one row before the kept rows
+            offset = trim - 1
+            t_first = start + (offset + hlen) * delta
+            n_steps -= offset
+            trim = 1
+    recorder = None
+    if recording:
+        first = 0 if record_tail is None else max(0, n_steps - int(ceil(record_tail / dt)))
+        recorder = _Recorder(n_steps, first, record_every, float if record_dtype is None else record_dtype,
+                             record_traces)
+        if spec is not None or getattr(control_mechanism, 'step', None) is not None or \
+                getattr(control_mechanism, 'window', None) is not None:
+            keep_history = False
+    if spec is not None:
+        n = n_steps if keep_history else min(hlen + 2, n_steps)
+    else:
+        # interpolation stencils of the higher-order methods reach up to 2 rows further back
+        n = _delay_line_length(n_steps, hlen if method == 'euler' else hlen + 2, control_mechanism, keep_history)
+    detectors = _detectors(stop_when)
+    if detectors:
+        after = _last_event(mid_increase, steady_state_pad, control_start + steady_state_pad, drives)
+    if detectors and not keep_history:
+        n = min(max(n, max(_detector_rows(d, dt) for d in detectors) + 1), n_steps)
+    block = max(1, int(round(check_every / dt))) if detectors else _BLOCK
+    if recorder is not None:
+        # smaller blocks, the drive arrays would dominate memory otherwise; a whole block has to fit
+        # the delay line to be copied out
+        block = min(block, _RECORD_BLOCK)
+        n = min(max(n, block), n_steps)
+    history = np.zeros((n, 3))
     history[0:hlen + 1, :] = init_state
+    if init_history is None:
+        init_history = np.zeros((0, 3))
+    else:
+        init_history = np.asarray(init_history, dtype=float)
+        if len(init_history) < hlen + 1:
+            raise ValueError('init_history needs at least %d rows' % (hlen + 1))
+        history[0:hlen + 1, :] = init_history[:hlen + 1]
+    given = len(init_history)
 
     d11 = int(floor(constants[6] / dt))
     d12 = int(floor(constants[7] / dt))
     d21 = int(floor(constants[8] / dt))
     d22 = int(floor(constants[9] / dt))
-    for i, t in enumerate(tt):
-        if t <= 0:
+    control_from = control_start + steady_state_pad
+
+    if spec is not None:
+        ctrl_kind, ctrl_params = spec
+        kconstants = np.asarray(constants, dtype=float)
+        ctrl_params = np.asarray(ctrl_params, dtype=float)
+        ctrl_state = np.array([control_mechanism.w], dtype=float)
+    else:
+        step = None if keep_history else getattr(control_mechanism, 'step', None)
+        controller = control_mechanism
+        if profile is not None:
+            controller = profile.timed('controller', controller)
+            step = profile.timed('controller', step)
+        if realtime is not None:
+            controller = realtime.paced(controller)
+            step = realtime.paced(step)
+        r0 = 1 / constants[0]
+        r1 = 1 / constants[1]
+        c2, c3, c4, c5 = constants[2:6]
+        m1, b1, m2, b2 = constants[10:14]
+    rk = None
+    if method != 'euler':
+        def row(t):
+            # fractional row of time t, snapped to a grid point it falls on
+            r = (t - start) / delta
+            return round(r) if abs(r - round(r)) < 1e-6 else r
+        # given rows are read as they are, a seeded history has no kink at row hlen
+        breaks = [0 if given else hlen]
+        if mid_increase[1] > 0 or mid_increase[2] > 0:
+            breaks.append(row(mid_increase[0] + steady_state_pad))
+        rk = _RungeKutta(method, constants, dt, rtol, atol, None if given else init_state, breaks)
+    info = {'method': method, 'steps': 0, 'reason': None}
+
+    trace = recorder is not None and record_traces
+    control_trace = row_ext1 = row_ext2 = np.zeros(0)
+    stop = n_steps
+    # blocks stay on the grid of a run from row 0, so a cached pad leaves the convergence checks in place
+    for i0 in range(-(offset % block), n_steps, block):
+        i1 = min(i0 + block, n_steps)
+        i0 = max(i0, 0)
+        if detectors and i0 > 0:
+            if profile is not None:
+                profile.switch('convergence')
+            fired = _converged(detectors, history, i0, start + (offset + i0 - 1) * delta, dt, hlen, after=after)
+            if fired.any():
+                stopped_by = detectors[int(np.argmax(fired))]
+                info['reason'] = stopped_by.reason
+                stop = i0
+                break
+        if profile is not None:
+            profile.switch('inputs')
+        tt = start + np.arange(offset + i0, offset + i1) * delta
+        info['steps'] += int(np.count_nonzero(tt[max(given - i0, 0):] > t_first))
+        if rk is None:
+            t_inputs = tt
+        elif rk.adaptive:
+            t_inputs = tt[:0]
+        else:
+            # stage times of the step that ends at each row, counted in dt from start like the breaks
+            # (the np.arange grid drifts by many ulps over a long run)
+            t_inputs = start + (np.arange(i0, i0 + len(tt))[:, np.newaxis] - 1 + np.asarray(rk.c_drive)) * dt
+        ctx_input, str_input, _ = drive_waveforms(constants, t_inputs, mid_increase, steady_state_pad, route,
+                                                  drives, i0)
+        ext1 = constants[14] * ctx_input
+        ext2 = constants[15] * str_input
+        if trace:
+            control_trace = np.zeros(len(tt))
+            row_ext1, row_ext2 = ext1, ext2
+            if rk is not None:
+                ctx_input, str_input, _ = drive_waveforms(constants, tt, mid_increase, steady_state_pad, route,
+                                                          drives, i0)
+                row_ext1, row_ext2 = constants[14] * ctx_input, constants[15] * str_input
+        if spec is not None:
+            if profile is not None:
+                profile.switch('kernel')
+            kernels.euler_kernel(history, i0, tt, float(t_first), float(dt), kconstants, d11, d12, d21, d22,
+                                 float(control_from), ext1, ext2, ctrl_kind, ctrl_params, ctrl_state, init_history,
+                                 control_trace)
+            if recorder is not None:
+                recorder.block(_window(history, i0 + len(tt), len(tt)), i0, control_trace, row_ext1, row_ext2)
+            if profile is not None:
+                profile.block(i0, i0 + len(tt), history)
             continue
-        state = history[i - 1]
-
-        control1, grad_theta = control_mechanism(history[:i, :])
-        if t < control_start + steady_state_pad:
-            control1, grad_theta = (0, 0)
-
-        ampl_boost = 0
-        if mi_amplitude > 0 and t > mi_t + steady_state_pad:
-            ampl_boost = mi_amplitude
-
-        amplitude = constants[16] + ampl_boost
-        f = constants[17]
-        ctx_level = constants[18]
-        str_level = constants[19]
-        oscillating_input = amplitude * np.sin(2 * np.pi * f * t / 1000)
-
-        str_input = str_level
-        ctx_input = ctx_level + oscillating_input
-        if mi_mean > 0:
-            if t > mi_t + steady_state_pad:
-                ctx_input += mi_mean
-        # TODO: calculate the inputs in a smart way
-        inputs1 = constants[2] * history[i - 1 - d11, 0] + \
-                  constants[3] * history[i - 1 - d12, 1] + constants[14] * ctx_input
-        inputs2 = constants[4] * history[i - 1 - d21, 0] + \
-                  constants[5] * history[i - 1 - d22, 1] + constants[15] * str_input
-        grad = np.array([
-            1 / constants[0] * (-state[0] + activation1(inputs1 + control1, constants)),
-            1 / constants[1] * (-state[1] + activation2(inputs2, constants)),
-            grad_theta
-        ])
-        history[i] = history[i - 1] + grad * dt
-        control_history[i] = control1
-        input_history[i] = oscillating_input
-
-    return history
+        if profile is not None:
+            profile.switch('loop')
+
+        for j, t in enumerate(tt.tolist()):
+            if t <= t_first:
+                continue
+            i = i0 + j
+            state = history[(i - 1) % n]
+
+            if keep_history:
+                control1, grad_theta = controller(history[:i, :])
+            elif step is not None:
+                control1, grad_theta = step(state, t)
+            else:
+                control1, grad_theta = controller(_window(history, i, control_mechanism.window))
+            if t < control_from:
+                control1, grad_theta = (0, 0)
+            if trace:
+                control_trace[j] = control1
+            if i < given:
+                history[i % n] = init_history[i]
+                continue
+
+            s0, s1, s2 = state
+            if rk is None:
+                inputs1 = c2 * history[(i - 1 - d11) % n, 0] + c3 * history[(i - 1 - d12) % n, 1] + ext1[j]
+                inputs2 = c4 * history[(i - 1 - d21) % n, 0] + c5 * history[(i - 1 - d22) % n, 1] + ext2[j]
+                history[i % n] = (
+                    s0 + r0 * (-s0 + sigmoid(inputs1 + control1, m1, b1)) * dt,
+                    s1 + r1 * (-s1 + sigmoid(inputs2, m2, b2)) * dt,
+                    s2 + grad_theta * dt
+                )
+                continue
+
+            if rk.adaptive:
+                def inputs(offsets, t_prev=start + (i - 1) * dt, i=i):
+                    ctx, str_, _ = drive_waveforms(constants, t_prev + np.multiply(offsets, dt)[np.newaxis],
+                                                   mid_increase, steady_state_pad, route, drives, i)
+                    return constants[14] * ctx[0], constants[15] * str_[0]
+                x0, x1 = rk.adaptive_step(history, n, i, s0, s1, control1, inputs)
+            else:
+                x0, x1 = rk.step(history, n, i, s0, s1, control1, ext1[j], ext2[j])
+            history[i % n] = (x0, x1, s2 + grad_theta * dt)
+        if recorder is not None:
+            recorder.block(_window(history, i0 + len(tt), len(tt)), i0, control_trace, row_ext1, row_ext2)
+        if profile is not None:
+            profile.block(i0, i0 + len(tt), history)
+
+    if profile is not None:
+        profile.switch('output')
+    if spec is not None:
+        control_mechanism.w = ctrl_state[0]
+    if stop < n_steps:
+        window = _window(history, stop, _detector_rows(stopped_by, dt))
+        tail = stopped_by.extrapolate(window, dt, n_steps - stop)
+        if recorder is not None:
+            recorder.block(tail, stop)
+        else:
+            history = np.concatenate((_unroll(history, stop), tail))[-n:]
+    elif recorder is None:
+        history = _unroll(history, n_steps)
+    if recorder is None and keep_history:
+        history = history[trim:]
+    if recorder is not None:
+        history = recorder.history
+        info['time'] = start + recorder.rows * delta
+        if trace:
+            info['control'] = recorder.control
+            info['inputs'] = recorder.inputs
+    info['stop_time'] = start + (offset + stop - 1) * delta
+    if rk is not None and rk.adaptive:
+        info['steps'] = rk.steps
+        info['rejected'] = rk.rejected
+    if profile is not None:
+        profile.stop()
+        profile.count('steps', info['steps'])
+        info['profile'] = profile.summary()
+    if realtime is not None:
+        info['realtime'] = realtime.summary()
+    if not full_output:
+        return history
+    return history, info
+
+
+def _pad_state(cache, constants, dt, control_mechanism, control_start, init_state, steady_state_pad, route,
+               backend):
+    # (delay line, hlen + 1 rows, and controller state w) at the end of the pad, the last rows of
+    # a run up to t = steady_state_pad with a copy of the controller: it is called over the pad but
+    # off until control_start + steady_state_pad, and mid_increase comes later. Stored as one array
+    # with (w, 0, 0) as an extra last row. The backend is part of the key: the adaptive controllers
+    # amplify even rounding differences.
+    kind, params = _kernel_spec(control_mechanism)
+    key = cache.key(constants=[float(c) for c in constants], dt=dt, init_state=np.broadcast_to(init_state, (3,)),
+                    steady_state_pad=steady_state_pad, route=route, backend=backend, control_start=control_start,
+                    controller=[int(kind)] + [float(p) for p in params], w=float(control_mechanism.w))
+    rows = cache.get(key)
+    if rows is None:
+        controller = copy.deepcopy(control_mechanism)
+        hlen = int(floor(max(constants[6:10]) / dt))
+        history = simulate(constants, 0, dt, controller, control_start, init_state, steady_state_pad=steady_state_pad,
+                           route=route, backend=backend, keep_history=False)
+        rows = np.concatenate((history[-(hlen + 1):], [[controller.w, 0, 0]]))
+        cache.put(key, rows)
+    return rows[:-1], rows[-1, 0]
 
 
-def single_simulation_striatal(constants, simulation_time, dt, control_mechanism, control_start=200, init_state=[20, 20, 40],
-                      mid_increase=(750, 0, 0), steady_state_pad=0):
-    max_delay = max(constants[6:10])
-    tt = np.arange(-max_delay, simulation_time + steady_state_pad, dt)
-    history = np.zeros((len(tt), 3))
-    control_history = np.zeros((len(tt),))
-    input_history = np.zeros((len(tt),))
+def single_simulation(constants, simulation_time, dt, control_mechanism, control_start=200, init_state=[20, 20, 40],
+                      mid_increase=(750, 0, 0), steady_state_pad=0, backend='python', keep_history=True,
+                      steady_state_cache=None, realtime=None, method='euler', rtol=1e-6, atol=1e-6):
+    return simulate(constants, simulation_time, dt, control_mechanism, control_start, init_state, mid_increase,
+                    steady_state_pad, route='ctx', backend=backend, keep_history=keep_history, method=method,
+                    rtol=rtol, atol=atol, steady_state_cache=steady_state_cache, realtime=realtime)
 
-    mi_t = mid_increase[0]
-    mi_mean = mid_increase[1]
-    mi_amplitude = mid_increase[2]
 
-    hlen = int(floor(max_delay / dt))
-    history[0:hlen + 1, :] = init_state
+def single_simulation_striatal(constants, simulation_time, dt, control_mechanism, control_start=200, init_state=[20, 20, 40],
+                      mid_increase=(750, 0, 0), steady_state_pad=0, backend='python', keep_history=True,
+                      steady_state_cache=None, realtime=None, method='euler', rtol=1e-6, atol=1e-6):
+    return simulate(constants, simulation_time, dt, control_mechanism, control_start, init_state, mid_increase,
+                    steady_state_pad, route='str', backend=backend, keep_history=keep_history, method=method,
+                    rtol=rtol, atol=atol, steady_state_cache=steady_state_cache, realtime=realtime)
+
+
+def batch_simulation(constants, simulation_time, dt, control_mechanism=None, control_start=200,
+                     init_state=[20, 20, 40], mid_increase=(750, 0, 0), steady_state_pad=0, route='ctx', drives=None,
+                     stop_when=None, check_every=50, full_output=False):
+    # constants: (N, 20), one parameter set per row; init_state: (3,) or (N, 3).
+    # control_mechanism, if given, is called with the (N, 3) state matrix on every step, like the
+    # controllers of simulate, and returns (control, grad_theta), each broadcastable to (N,); both are
+    # zeroed before control_start. See the controller banks in controller.py.
+    # Returns a (N, len(tt), 3) array; all rows share the time grid of the longest delay.
+    # With stop_when (see simulate) rows that have converged are extrapolated and no longer integrated;
+    # full_output=True also returns per-row 'reason' and 'stop_time' (nan for rows that ran to the end)
+    # and 'control_energy', the integral of the squared control input up to the stop.
+    constants = np.atleast_2d(np.asarray(constants, dtype=float))
+    n = constants.shape[0]
+    rows = np.arange(n)
+
+    max_delay = np.max(constants[:, 6:10])
+    start, delta, n_steps = _time_grid(max_delay, simulation_time + steady_state_pad, dt)
+    history = np.zeros((n_steps, n, 3))
 
-    d11 = int(floor(constants[6] / dt))
-    d12 = int(floor(constants[7] / dt))
-    d21 = int(floor(constants[8] / dt))
-    d22 = int(floor(constants[9] / dt))
-    for i, t in enumerate(tt):
-        if t <= 0:
-            continue
-        state = history[i - 1]
-
-        control1, grad_theta = control_mechanism(history[:i, :])
-        if t < control_start + steady_state_pad:
-            control1, grad_theta = (0, 0)
-
-        ampl_boost = 0
-        if mi_amplitude > 0 and t > mi_t + steady_state_pad:
-            ampl_boost = mi_amplitude
-
-        amplitude = constants[16] + ampl_boost
-        f = constants[17]
-        ctx_level = constants[18]
-        str_level = constants[19]
-        oscillating_input = amplitude * np.sin(2 * np.pi * f * t / 1000)
-
-        str_input = str_level + oscillating_input
-        ctx_input = ctx_level 
-        if mi_mean > 0:
-            if t > mi_t + steady_state_pad:
-                str_input += mi_mean
-        # TODO: calculate the inputs in a smart way
-        inputs1 = constants[2] * history[i - 1 - d11, 0] + \
-                  constants[3] * history[i - 1 - d12, 1] + constants[14] * ctx_input
-        inputs2 = constants[4] * history[i - 1 - d21, 0] + \
-                  constants[5] * history[i - 1 - d22, 1] + constants[15] * str_input
-        grad = np.array([
-            1 / constants[0] * (-state[0] + activation1(inputs1 + control1, constants)),
-            1 / constants[1] * (-state[1] + activation2(inputs2, constants)),
-            grad_theta
-        ])
-        history[i] = history[i - 1] + grad * dt
-        control_history[i] = control1
-        input_history[i] = oscillating_input
-
-    return history
\ No newline at end of file
+    hlen = int(floor(max_delay / dt))
+    history[0:hlen + 1] = np.broadcast_to(init_state, (n, 3))
+
+    d11 = np.floor(constants[:, 6] / dt).astype(int)
+    d12 = np.floor(constants[:, 7] / dt).astype(int)
+    d21 = np.floor(constants[:, 8] / dt).astype(int)
+    d22 = np.floor(constants[:, 9] / dt).astype(int)
+    c = constants.T
+    detectors = _detectors(stop_when)
+    if detectors:
+        after = _last_event(mid_increase, steady_state_pad, control_start + steady_state_pad, drives)
+    reasons = [None] * n
+    stop_times = np.full(n, np.nan)
+    energy = np.zeros(n)
+    # rows still integrated, and their parameters
+    active = rows
+    ca, d11a, d12a, d21a, d22a = c, d11, d12, d21, d22
+    block = max(1, int(round(check_every / dt))) if detectors else max(1, _BLOCK * 16 // n)
+    for i0 in range(0, n_steps, block):
+        if detectors and i0 > 0:
+            t_last = start + (i0 - 1) * delta
+            fired = _converged(detectors, history, i0, t_last, dt, hlen, active, after)
+            done = fired.any(axis=0)
+            if done.any():
+                for k, f in zip(active[done], fired[:, done].T):
+                    detector = detectors[int(np.argmax(f))]
+                    window = _window(history, i0, _detector_rows(detector, dt))[:, k]
+                    history[i0:, k] = detector.extrapolate(window, dt, n_steps - i0)
+                    reasons[k] = detector.reason
+                    stop_times[k] = t_last
+                active = active[~done]
+                if len(active) == 0:
+                    break
+                ca, d11a, d12a, d21a, d22a = c[:, active], d11[active], d12[active], d21[active], d22[active]
+        tt = start + np.arange(i0, min(i0 + block, n_steps)) * delta
+        ctx_input, str_input, _ = drive_waveforms(c, tt[:, np.newaxis], mid_increase, steady_state_pad, route,
+                                                  drives, i0)
+        ext1 = c[14] * ctx_input
+        ext2 = c[15] * str_input
+        for j, t in enumerate(tt):
+            if t <= 0:
+                continue
+            i = i0 + j
+            state = history[i - 1, active]
+
+            if control_mechanism is None:
+                control1, grad_theta = (0, 0)
+            else:
+                # the controller always sees the whole batch, extrapolated rows included
+                control1, grad_theta = control_mechanism(history[i - 1])
+                if t < control_start + steady_state_pad:
+                    control1, grad_theta = (0, 0)
+                else:
+                    control1 = np.broadcast_to(control1, (n,))[active]
+                    grad_theta = np.broadcast_to(grad_theta, (n,))[active]
+                    energy[active] += control1 ** 2 * dt
+
+            inputs1 = ca[2] * history[i - 1 - d11a, active, 0] + ca[3] * history[i - 1 - d12a, active, 1] + \
+                ext1[j, active]
+            inputs2 = ca[4] * history[i - 1 - d21a, active, 0] + ca[5] * history[i - 1 - d22a, active, 1] + \
+                ext2[j, active]
+            history[i, active, 0] = state[:, 0] + 1 / ca[0] * (-state[:, 0] + sigmoid(inputs1 + control1, ca[10],
+                                                                                      ca[11])) * dt
+            history[i, active, 1] = state[:, 1] + 1 / ca[1] * (-state[:, 1] + sigmoid(inputs2, ca[12], ca[13])) * dt
+            history[i, active, 2] = state[:, 2] + grad_theta * dt
+
+    history = np.moveaxis(history, 1, 0)
+    if not full_output:
+        return history
+    return history, {'reason': reasons, 'stop_time': stop_times, 'control_energy': energy}
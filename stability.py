@@ -0,0 +1,174 @@
+import numpy as np
+from scipy.optimize import brentq
+
+from simulation import activation1, activation2
+
+
+# Linear stability of the delayed STN/GPe model around its fixed points, with the external inputs held
+# at their levels (constants[18:20], the oscillating part left out):
+#   tau1 x1' = -x1 + S1(c11 x1(t - d11) + c12 x2(t - d12) + cctx ctx)
+#   tau2 x2' = -x2 + S2(c21 x1(t - d21) + c22 x2(t - d22) + cstr str)
+# Times in ms, so growth rates are in 1/ms and frequencies come out in Hz after * 1000 / (2 pi).
+
+
+def _inputs(constants):
+    return constants[14] * constants[18], constants[15] * constants[19]
+
+
+def _gpe_given_stn(constants, x1, iterations=60):
+    # x2 with x2 = S2(c21 x1 + c22 x2 + cstr str), unique as long as c22 <= 0: brentq for a single x1,
+    # bisection on [0, m2] vectorized over an array
+    _, i2 = _inputs(constants)
+    if np.ndim(x1) == 0:
+        return brentq(lambda x2: activation2(constants[4] * x1 + constants[5] * x2 + i2, constants) - x2,
+                      0, constants[12])
+    lo = np.zeros(np.shape(x1))
+    hi = np.full(np.shape(x1), float(constants[12]))
+    for _ in range(iterations):
+        mid = (lo + hi) / 2
+        above = activation2(constants[4] * x1 + constants[5] * mid + i2, constants) > mid
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+    return (lo + hi) / 2
+
+
+def fixed_points(constants, samples=200):
+    # all fixed points (x1, x2), found by bracketing x1 on a grid over [0, m1]
+    i1, _ = _inputs(constants)
+
+    def residual(x1):
+        x2 = _gpe_given_stn(constants, x1)
+        return activation1(constants[2] * x1 + constants[3] * x2 + i1, constants) - x1
+
+    grid = np.linspace(0, constants[10], samples)
+    values = residual(grid)
+    points = []
+    for k in np.flatnonzero(np.sign(values[:-1]) != np.sign(values[1:])):
+        x1 = brentq(residual, grid[k], grid[k + 1])
+        points.append((x1, _gpe_given_stn(constants, x1)))
+    return points
+
+
+def _slope(y, m):
+    # derivative of sigmoid(., m, b) where it takes the value y
+    return 4 * (y / m) * (1 - y / m)
+
+
+def linearization(constants, fixed_point):
+    # the linearized system u' = sum_k B_k u(t - tau_k) as a list of (tau_k, B_k)
+    tau1, tau2 = constants[0], constants[1]
+    g1 = _slope(fixed_point[0], constants[10])
+    g2 = _slope(fixed_point[1], constants[12])
+    terms = [(0, np.diag([-1 / tau1, -1 / tau2]))]
+    for (row, col), gain, delay in [((0, 0), g1 * constants[2] / tau1, constants[6]),
+                                     ((0, 1), g1 * constants[3] / tau1, constants[7]),
+                                     ((1, 0), g2 * constants[4] / tau2, constants[8]),
+                                     ((1, 1), g2 * constants[5] / tau2, constants[9])]:
+        b = np.zeros((2, 2))
+        b[row, col] = gain
+        terms.append((delay, b))
+    return terms
+
+
+def _chebyshev(n, tau):
+    # nodes on [-tau, 0] (the first one at 0), differentiation matrix and barycentric weights
+    x = np.cos(np.pi * np.arange(n + 1) / n)
+    c = np.ones(n + 1)
+    c[[0, -1]] = 2
+    c *= (-1) ** np.arange(n + 1)
+    dx = x[:, np.newaxis] - x
+    d = np.outer(c, 1 / c) / (dx + np.eye(n + 1))
+    d -= np.diag(d.sum(axis=1))
+    weights = (-1.) ** np.arange(n + 1)
+    weights[[0, -1]] /= 2
+    return tau * (x - 1) / 2, d * 2 / tau, weights
+
+
+def _interpolation_row(nodes, weights, theta):
+    diff = theta - nodes
+    exact = np.flatnonzero(diff == 0)
+    if len(exact):
+        row = np.zeros(len(nodes))
+        row[exact[0]] = 1
+        return row
+    row = weights / diff
+    return row / row.sum()
+
+
+def _characteristic(terms, lam):
+    # Delta(lambda) = lambda I - sum_k B_k exp(-lambda tau_k) and its derivative
+    delta = lam * np.eye(2, dtype=complex)
+    ddelta = np.eye(2, dtype=complex)
+    for tau, b in terms:
+        e = np.exp(-lam * tau)
+        delta -= b * e
+        ddelta += tau * b * e
+    return delta, ddelta
+
+
+def characteristic_roots(terms, count=4, n=12, newton_steps=20, tol=1e-12):
+    # Rightmost roots of det Delta(lambda) = 0: eigenvalues of the Chebyshev collocation of the
+    # infinitesimal generator of the delay equation (n + 1 nodes on [-max delay, 0]), each refined by
+    # Newton's method on the determinant. Sorted by decreasing real part.
+    tau_max = max(tau for tau, _ in terms)
+    if tau_max == 0:
+        estimates = np.linalg.eigvals(sum(b for _, b in terms))
+    else:
+        nodes, d, weights = _chebyshev(n, tau_max)
+        generator = np.kron(d, np.eye(2))
+        generator[:2] = sum(np.kron(_interpolation_row(nodes, weights, -tau), b) for tau, b in terms)
+        estimates = np.linalg.eigvals(generator)
+    estimates = estimates[np.argsort(-estimates.real)][:2 * count]
+    roots = []
+    for lam in estimates:
+        for _ in range(newton_steps):
+            delta, ddelta = _characteristic(terms, lam)
+            try:
+                step = 1 / np.trace(np.linalg.solve(delta, ddelta))
+            except np.linalg.LinAlgError:
+                break
+            lam = lam - step
+            if abs(step) < tol * max(1, abs(lam)):
+                break
+        if not any(abs(lam - r) < 1e-8 * max(1, abs(lam)) for r in roots):
+            roots.append(lam)
+    roots.sort(key=lambda r: -r.real)
+    return np.array(roots[:count])
+
+
+def rightmost_root(constants, n=12):
+    # rightmost characteristic root at the most stable fixed point (the one whose rightmost root has
+    # the smallest real part), nan if there is no fixed point
+    best = complex(np.nan, np.nan)
+    for point in fixed_points(constants):
+        root = characteristic_roots(linearization(constants, point), count=1, n=n)[0]
+        if np.isnan(best.real) or root.real < best.real:
+            best = root
+    return best
+
+
+def stability_map(constants, c12_range, c21_range, n=12):
+    # growth rate [1/ms] and frequency [Hz] of the rightmost root over a (c12, c21) grid; growth > 0
+    # marks the points without a stable fixed point, where the model oscillates
+    growth = np.full((len(c12_range), len(c21_range)), np.nan)
+    frequency = np.full_like(growth, np.nan)
+    for i, c12 in enumerate(c12_range):
+        for j, c21 in enumerate(c21_range):
+            c = list(constants)
+            c[3] = c12
+            c[4] = c21
+            root = rightmost_root(c, n)
+            growth[i, j] = root.real
+            frequency[i, j] = abs(root.imag) * 1000 / (2 * np.pi)
+    return growth, frequency
+
+
+def stability_boundary(c12_range, c21_range, growth):
+    # (c12, c21) points where the growth rate changes sign along c21, linearly interpolated
+    boundary = []
+    for i, c12 in enumerate(c12_range):
+        g = growth[i]
+        for j in np.flatnonzero(np.sign(g[:-1]) * np.sign(g[1:]) < 0):
+            c21 = c21_range[j] + (c21_range[j + 1] - c21_range[j]) * g[j] / (g[j] - g[j + 1])
+            boundary.append((c12, c21))
+    return np.array(boundary).reshape(-1, 2)
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from result_store import _to_json
+
+
+class SteadyStateCache:
+    # Delay lines and controller states at the end of steady_state_pad, one .npy file per content hash
+    # of everything that determines them (see simulation._pad_state). Hits refresh the file's modification time; when
+    # the directory grows beyond max_bytes the least recently used files are deleted.
+    def __init__(self, path, max_bytes=512 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, **fields):
+        text = json.dumps(fields, sort_keys=True, default=_to_json)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def get(self, key):
+        try:
+            data = np.load(self._file(key))
+        except (OSError, ValueError):
+            return None
+        os.utime(self._file(key))
+        return data
+
+    def put(self, key, data):
+        tmp = self._file(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, self._file(key))
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.path, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if name != keep + '.npy':
+                os.remove(os.path.join(self.path, name))
+                total -= size
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(self.path, name))
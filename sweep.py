@@ -0,0 +1,250 @@
+import hashlib
+import itertools
+import multiprocessing
+import pickle
+from math import floor
+
+import numpy as np
+from scipy.interpolate import griddata
+
+from analysis import band_amplitude
+from controller import ZeroController
+from simulation import batch_simulation, simulate
+
+
+def grid_points(grid):
+    # grid: {parameter: values}; yields (index tuple, {parameter: value}) over the cartesian product
+    names = list(grid)
+    for idx in itertools.product(*(range(len(grid[name])) for name in names)):
+        yield idx, {name: grid[name][k] for name, k in zip(names, idx)}
+
+
+def serpentine_points(grid):
+    # same points as grid_points, ordered so that consecutive points are grid neighbours: every
+    # other pass along an axis runs backwards
+    names = list(grid)
+    order = [()]
+    for name in reversed(names):
+        order = [(k,) + rest for k in range(len(grid[name])) for rest in (order if k % 2 == 0 else order[::-1])]
+    for idx in order:
+        yield idx, {name: grid[name][k] for name, k in zip(names, idx)}
+
+
+def tail_amplitude(history, dt, tail_len=800, band=(16, 24), div=10):
+    # peak-to-peak of STN and GPe over the last tail_len ms, band-passed after decimation when band is given;
+    # history is (T, 3) or (N, T, 3)
+    return band_amplitude(history[..., :2], dt, band, div, tail_len, axis=-2)
+
+
+class AmplitudePoint:
+    # Per-point sweep function: overrides entries of `constants` by index with the point's parameters,
+    # runs single_simulation and returns tail_amplitude of the result. `controller` is a picklable
+    # zero-argument factory (e.g. functools.partial) or None for no control.
+    def __init__(self, constants, simulation_time, dt, controller=None, tail_len=800, band=(16, 24), div=10,
+                 **simulation_kwargs):
+        self.constants = list(constants)
+        self.simulation_time = simulation_time
+        self.dt = dt
+        self.controller = controller
+        self.tail_len = tail_len
+        self.band = band
+        self.div = div
+        self.simulation_kwargs = simulation_kwargs
+
+    def _constants(self, params):
+        constants = list(self.constants)
+        for k, v in params.items():
+            constants[k] = v
+        return constants
+
+    def __call__(self, params):
+        return self.run(params)[0]
+
+    def run(self, params, init_history=None, simulation_time=None):
+        # (amplitude, final delay line, unfiltered peak-to-peak of STN and GPe over the last tail_len
+        # ms); init_history seeds the run with the delay line of another one
+        constants = self._constants(params)
+        rows = int(floor(max(constants[6:10]) / self.dt)) + 1
+        if init_history is not None and len(init_history) < rows:
+            # the previous point had shorter delays: hold its oldest row
+            init_history = np.concatenate((np.repeat(init_history[:1], rows - len(init_history), axis=0),
+                                           init_history))
+        controller = self.controller() if self.controller is not None else ZeroController()
+        history = simulate(constants, simulation_time or self.simulation_time, self.dt, controller,
+                           init_history=init_history, **self.simulation_kwargs)
+        tail = history[-max(1, int(self.tail_len / self.dt)):, :2]
+        return tail_amplitude(history, self.dt, self.tail_len, self.band, self.div), history[-rows:], \
+            np.ptp(tail, axis=0)
+
+    def batch(self, params_list):
+        # whole chunk in one batch_simulation call; only for uncontrolled runs
+        if self.controller is not None:
+            return [self(params) for params in params_list]
+        kwargs = {k: v for k, v in self.simulation_kwargs.items() if k != 'backend'}
+        history = batch_simulation([self._constants(p) for p in params_list], self.simulation_time, self.dt,
+                                   **kwargs)
+        return list(tail_amplitude(history, self.dt, self.tail_len, self.band, self.div))
+
+
+def load_results(store, name):
+    # {index tuple: result} for the points of sweep `name` already in the store
+    if name + '.keys' not in store:
+        return {}
+    keys = store.load(name + '.keys')
+    values = store.load(name + '.values')
+    return {tuple(int(k) for k in key): np.array(value) for key, value in zip(keys, values)}
+
+
+def settings_key(function, grid):
+    # content hash of a sweep: the point function as it is pickled for the pool (for AmplitudePoint
+    # its constants, dt, controller factory and simulation keyword arguments) and the grid values
+    grid = {name: np.asarray(values).tolist() for name, values in grid.items()}
+    return hashlib.sha256(pickle.dumps((function, grid), protocol=4)).hexdigest()
+
+
+def _resume(store, name, key):
+    # the points of sweep `name` already in the store, which must have been computed with the
+    # settings of key
+    results = load_results(store, name)
+    if results and store.attrs(name).get('settings') != key:
+        raise ValueError("'%s' in the store was computed with other settings; use a new name or store" % name)
+    if not results:
+        store.set_attrs(name, settings=key)
+    return results
+
+
+def _run_chunk(args):
+    function, chunk, batched = args
+    params = [p for _, p in chunk]
+    values = function.batch(params) if batched else [function(p) for p in params]
+    return [(key, value) for (key, _), value in zip(chunk, values)]
+
+
+def _evaluate(function, todo, store, name, results, processes, chunksize, batched):
+    # runs the (index, params) points of todo on a process pool, appending each finished chunk to
+    # the store and to results
+    chunks = [(function, todo[k:k + chunksize], batched) for k in range(0, len(todo), chunksize)]
+    with multiprocessing.Pool(processes) as pool:
+        for records in pool.imap_unordered(_run_chunk, chunks):
+            store.append_many({
+                name + '.keys': np.array([key for key, _ in records]),
+                name + '.values': np.array([value for _, value in records])
+            })
+            results.update(records)
+
+
+def run_sweep(function, grid, store, name, processes=None, chunksize=1, batched=False):
+    # Evaluates function over the grid on a process pool, appending each finished chunk to the
+    # datasets name.keys / name.values of a ResultStore. Points already in the store are
+    # skipped, so an interrupted sweep resumes where it stopped. The store records settings_key of
+    # the function and grid, and a rerun with other settings raises instead of resuming; use a new
+    # name (or store) to start over. With batched=True, function.batch receives a whole chunk.
+    results = _resume(store, name, settings_key(function, grid))
+    todo = [(idx, params) for idx, params in grid_points(grid) if idx not in results]
+    if not todo:
+        return results
+    print('%d of %d points left' % (len(todo), len(todo) + len(results)))
+    _evaluate(function, todo, store, name, results, processes, chunksize, batched)
+    return results
+
+
+def refined_grid(grid, depth):
+    # the grid with every interval split into 2 ** depth: the lattice run_refinement works on
+    return {name: np.linspace(values[0], values[-1], (len(values) - 1) * 2 ** depth + 1)
+            for name, values in grid.items()}
+
+
+def _split(cell, result, threshold, tol, component):
+    # whether the corner results of a cell straddle threshold or differ by more than tol
+    values = np.array([np.asarray(result[corner]).flat[component] for corner in cell])
+    if threshold is not None and values.min() < threshold <= values.max():
+        return True
+    return tol is not None and np.ptp(values) > tol
+
+
+def run_refinement(function, grid, store, name, depth=3, threshold=None, tol=None, component=0, processes=None,
+                   chunksize=1, batched=False):
+    # Adaptive version of run_sweep (a quadtree for two parameters): evaluates the coarse, uniform
+    # grid, then splits every cell whose corner results straddle threshold or differ by more than
+    # tol, up to depth times, each level in one pass of the pool. Results are compared on element
+    # `component` (0 = STN amplitude for AmplitudePoint). Points are indexed on
+    # refined_grid(grid, depth) and stored like those of run_sweep, so an interrupted refinement
+    # resumes too (with the same settings). Returns {index: result} for the points evaluated; see
+    # scattered and to_raster.
+    fine = refined_grid(grid, depth)
+    results = _resume(store, name, settings_key(function, fine))
+    size = 2 ** depth
+    corners = list(itertools.product((0, 1), repeat=len(grid)))
+    cells = [tuple(k * size for k in idx) for idx in itertools.product(*(range(len(v) - 1) for v in grid.values()))]
+    while True:
+        cell_points = {origin: [tuple(o + c * size for o, c in zip(origin, corner)) for corner in corners]
+                       for origin in cells}
+        todo = sorted({idx for points in cell_points.values() for idx in points if idx not in results})
+        if todo:
+            print('%d points at cell size %d' % (len(todo), size))
+            _evaluate(function, [(idx, {p: fine[p][k] for p, k in zip(fine, idx)}) for idx in todo], store, name,
+                      results, processes, chunksize, batched)
+        if size == 1:
+            return results
+        size //= 2
+        cells = [tuple(o + c * size for o, c in zip(origin, corner))
+                 for origin, points in cell_points.items() if _split(points, results, threshold, tol, component)
+                 for corner in corners]
+
+
+def scattered(results, grid, depth):
+    # results of run_refinement as (parameter values (N, len(grid)), results (N, ...))
+    fine = refined_grid(grid, depth)
+    keys = sorted(results)
+    points = np.array([[fine[p][k] for p, k in zip(fine, idx)] for idx in keys])
+    return points, np.array([results[idx] for idx in keys])
+
+
+def to_raster(points, values, grid, method='linear'):
+    # scattered results interpolated onto a grid (e.g. refined_grid(grid, depth)), shaped like to_array
+    mesh = np.meshgrid(*grid.values(), indexing='ij')
+    return griddata(points, values, tuple(mesh), method=method)
+
+
+def run_continuation(function, grid, warm_time=None, backward=True):
+    # Continuation sweep: visits the grid in serpentine order and seeds each run with the final delay
+    # line of the previous point, so it starts next to the attractor it is likely to settle on and
+    # can run for only warm_time ms (the first point runs for the full time). With backward=True the
+    # grid is then walked back the other way. Returns ({index: forward result}, {index: backward
+    # result}, {index: (forward, backward) unfiltered tail peak-to-peak}); points where the passes
+    # settle on different attractors (see hysteresis) lie in multistable regions that a cold start
+    # from a fixed init_state does not reveal. function is e.g. an AmplitudePoint; inputs should be
+    # constant in time, the clock restarts with each run.
+    order = list(serpentine_points(grid))
+    passes = [order, order[::-1]] if backward else [order]
+    results = []
+    spans = []
+    seed = None
+    for points in passes:
+        result = {}
+        span = {}
+        for idx, params in points:
+            result[idx], seed, span[idx] = function.run(params, seed, warm_time if seed is not None else None)
+        results.append(result)
+        spans.append(span)
+    if not backward:
+        return results[0], {}, {}
+    return results[0], results[1], {idx: (spans[0][idx], spans[1][idx]) for idx in spans[0]}
+
+
+def hysteresis(spans, rtol=0.25, atol=5.):
+    # {index: True where the forward and backward passes of run_continuation settled on different
+    # attractors}: their unfiltered tail peak-to-peak (a fixed point against a cycle, or cycles of
+    # different size) disagrees. Band-passed amplitudes are no use here, for cycles outside the band
+    # they mostly measure filter leakage and depend on the phase the run ends in.
+    return {idx: not np.allclose(forward, backward, rtol=rtol, atol=atol) for idx, (forward, backward) in spans.items()}
+
+
+def to_array(results, grid):
+    # results of run_sweep as an array shaped like the grid (plus the shape of one result)
+    shape = tuple(len(v) for v in grid.values())
+    first = np.asarray(next(iter(results.values())))
+    out = np.full(shape + first.shape, np.nan)
+    for idx, value in results.items():
+        out[idx] = value
+    return out